@@ -1,38 +1,83 @@
-from flask import Flask, request, jsonify, render_template, render_template_string, send_from_directory
+from flask import Flask, Request, request, jsonify, render_template, render_template_string, send_from_directory, Response
 from flask_cors import CORS
 import os
-import base64
 import json
+import time
 from datetime import datetime
 import uuid
 from werkzeug.utils import secure_filename
-import requests
 import hashlib
+import html
+import re
+import result_cache
+import image_pipeline
+import jobs
+import openai_client
+import trial_ledger
+import upload_store
+import datastore
+import scheduler
+import batching
+import upstream_guard
+import metrics
+
+class UploadRequest(Request):
+    # Stream multipart file parts straight into the upload store, hashing and sniffing as they arrive
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return upload_store.HashingUploadStream(app.config['UPLOAD_FOLDER'], app.config['MAX_UPLOAD_FILE_SIZE'])
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+metrics.init_app(app)
 CORS(app)
 
 # Configuration
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-key-not-for-production')
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024 # Increased max content length to 20MB for more images
+app.config['MAX_UPLOAD_FILE_SIZE'] = 10 * 1024 * 1024
 
 # Create upload directory
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+def start_background_workers():
+    # Upload expiry and scheduled post dispatch; each starts at most once per process
+    upload_store.start_sweeper(app.config['UPLOAD_FOLDER'])
+    scheduler.start()
+
+# The batch encoder's spawned processes re-import the main script as __mp_main__ when the
+# app runs as `python app.py`; they only encode images and must not start these threads
+if __name__ != '__mp_main__':
+    start_background_workers()
+
+# AI generation settings. Bump PROMPT_VERSION whenever the prompt or output format changes
+# so cached results from the old prompt are not served.
+AI_MODEL = "gpt-4o"
+PROMPT_VERSION = "2"
+MAX_COMPLETION_TOKENS = 1200
+# Rough upstream cost of one generation, used to pace bulk batches: the prompt text,
+# a fixed charge per low-detail image, and the full completion allowance
+PROMPT_TOKEN_ESTIMATE = 400
+LOW_DETAIL_IMAGE_TOKENS = 85
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 200))
+MAX_PERSONAS = 8
+JOB_EVENTS_MAX_SECONDS = int(os.getenv('JOB_EVENTS_MAX_SECONDS', 60))
+JOB_EVENTS_POLL_INTERVAL = 1.0
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def encode_image_to_base64(image_path):
-    try:
-        with open(image_path, 'rb') as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except Exception as e:
-        print(f"Base64 encoding error: {e}")
-        return None
+def resolve_upload_paths(file_paths):
+    valid_paths = []
+    for path in file_paths:
+        full_path = upload_store.storage_path(app.config['UPLOAD_FOLDER'], path)
+        if full_path and os.path.exists(full_path):
+            valid_paths.append(full_path)
+    upload_store.touch(file_paths)
+    return valid_paths
 
 def get_client_ip():
     if request.environ.get('HTTP_X_FORWARDED_FOR') is None:
@@ -44,24 +89,37 @@ def get_ip_hash():
     ip = get_client_ip()
     return hashlib.md5(ip.encode()).hexdigest()
 
+def get_user_key():
+    # Dashboard data is keyed by IP hash until there is real authentication. A client-supplied
+    # identity (such as an email header) would let anyone read or write another user's data.
+    return get_ip_hash()
+
+def record_generation(persona, user=None, fallback=False):
+    # Pass user when recording outside the request context (e.g. from a streamed response)
+    try:
+        datastore.get_store().record_generation(user or get_user_key(), persona, fallback)
+    except Exception as e:
+        print(f"Datastore error: {e}")
+
 def has_used_free_trial(ip_hash):
     try:
-        trial_file = 'free_trials_used.txt'
-        if os.path.exists(trial_file):
-            with open(trial_file, 'r') as f:
-                used_ips = f.read().splitlines()
-                return ip_hash in used_ips
+        return trial_ledger.has_used(ip_hash)
+    except Exception as e:
+        print(f"Trial ledger error: {e}")
         return False
-    except:
+
+def claim_free_trial(ip_hash):
+    try:
+        return trial_ledger.claim(ip_hash)
+    except Exception as e:
+        print(f"Trial ledger error: {e}")
         return False
 
-def mark_free_trial_used(ip_hash):
+def release_free_trial(ip_hash):
     try:
-        trial_file = 'free_trials_used.txt'
-        with open(trial_file, 'a') as f:
-            f.write(f"{ip_hash}\n")
-    except:
-        pass
+        trial_ledger.release(ip_hash)
+    except Exception as e:
+        print(f"Trial ledger error: {e}")
 
 def get_persona_context(persona):
     personas = {
@@ -89,6 +147,7 @@ def get_persona_context(persona):
     return personas.get(persona, personas["First-Time Homebuyers"])
 
 def generate_fallback_content(persona):
+    metrics.FALLBACKS.inc()
     persona_context = get_persona_context(persona)
     return {
         "listing": f"<h2>Perfect Home for {persona}!</h2><p>This beautiful property offers everything that {persona_context['description']} are looking for. With thoughtful design and modern amenities, this home addresses key priorities like {persona_context['priorities']}.</p>",
@@ -98,86 +157,288 @@ def generate_fallback_content(persona):
         "analysis": f"Property analyzed for {persona} targeting their priorities."
     }
 
-def analyze_property_with_ai(image_paths, persona):
-    try:
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            print("OpenAI API key not found, using fallback")
-            return generate_fallback_content(persona)
-        
-        # Prepare images for API
-        image_messages = []
+def build_image_messages(image_paths, encoded=None):
+    # encoded maps path -> data URL for images that were already encoded elsewhere
+    image_messages = []
+    with metrics.stage('image_encoding'):
         for path in image_paths: # Send all valid paths from the upload (up to 20 from frontend)
-            base64_image = encode_image_to_base64(path)
-            if base64_image:
+            image_url = encoded[path] if encoded is not None and path in encoded else image_pipeline.encode_for_vision(path)
+            if image_url:
                 image_messages.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "url": image_url,
                         "detail": "low" # Using 'low' detail to conserve tokens and speed up response
                     }
                 })
-        
-        if not image_messages:
-            print("No valid images for AI analysis")
-            return generate_fallback_content(persona)
-        
-        persona_context = get_persona_context(persona)
-        
-        prompt = f"""Analyze these property images and create marketing content for {persona}.
+    return image_messages
+
+# Sections the model must return in its JSON reply, and the type of each
+AI_CONTENT_SCHEMA = {
+    "listing": str,
+    "social": str,
+    "video": str,
+    "points": list,
+    "analysis": str
+}
+
+def build_vision_payload(image_messages, persona):
+    persona_context = get_persona_context(persona)
+    
+    prompt = f"""Analyze these property images and create marketing content for {persona}.
 
 Target buyer: {persona_context['description']}
 Key priorities: {persona_context['priorities']}
 Writing tone: {persona_context['tone']}
 
-Create a compelling 250-word property description that highlights features visible in the images that would appeal to {persona}. Focus on emotional appeal and specific details you can see."""
+Respond with a single JSON object with exactly these keys, in this order:
+- "listing": a compelling 250-word property description that highlights features visible in the images that would appeal to {persona}. Focus on emotional appeal and specific details you can see.
+- "social": a Facebook post of at most 60 words announcing the listing, ending with relevant hashtags.
+- "video": a 30-second video tour script (about 75 words).
+- "points": an array of 4 to 6 short key selling points drawn from the images.
+- "analysis": one or two sentences explaining why this property suits {persona}.
+Use plain text only, no HTML or markdown."""
+    
+    return {
+        "model": AI_MODEL, # Using the latest GPT-4o model for vision
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    *image_messages
+                ]
+            }
+        ],
+        "response_format": {"type": "json_object"},
+        "max_tokens": MAX_COMPLETION_TOKENS # Max tokens for the AI's text response (all five sections)
+    }
+
+def estimate_request_tokens(image_count):
+    return PROMPT_TOKEN_ESTIMATE + LOW_DETAIL_IMAGE_TOKENS * image_count + MAX_COMPLETION_TOKENS
+
+def parse_ai_content(raw_content):
+    """
+    Parses the model's JSON reply and checks it against AI_CONTENT_SCHEMA.
+    Raises ValueError if it is not usable.
+    """
+    try:
+        sections = json.loads(raw_content)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"AI response is not valid JSON: {e}")
+    if not isinstance(sections, dict):
+        raise ValueError("AI response is not a JSON object")
+    
+    parsed = {}
+    for key, expected_type in AI_CONTENT_SCHEMA.items():
+        value = sections.get(key)
+        if not isinstance(value, expected_type) or not value:
+            raise ValueError(f"AI response has a missing or invalid '{key}' section")
+        if expected_type is list:
+            value = [str(item).strip() for item in value if str(item).strip()]
+        else:
+            value = value.strip()
+        parsed[key] = value
+    return parsed
+
+def format_ai_content(sections, persona):
+    # Format AI response into structured content
+    points = ''.join(f"<li><strong>{html.escape(point)}</strong></li>" for point in sections['points'])
+    return {
+        "listing": f"<h2>Perfect Home for {persona}!</h2><p>{html.escape(sections['listing'])}</p>",
+        "social": f"<h3>Facebook Post:</h3><p>{html.escape(sections['social'])}</p>",
+        "video": f"<h3>30-Second Video Script:</h3><p>{html.escape(sections['video'])}</p>",
+        "points": f"<h3>Key Selling Points:</h3><ul>{points}</ul>",
+        "analysis": html.escape(sections['analysis'])
+    }
+
+def extract_partial_json_string(buffer, key):
+    """
+    Returns the decoded prefix of the string value of key in a partially received
+    JSON object, or None if the value has not started yet.
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), buffer)
+    if not match:
+        return None
+    raw = []
+    escaped = False
+    for char in buffer[match.end():]:
+        if char == '"' and not escaped:
+            break
+        raw.append(char)
+        escaped = char == '\\' and not escaped
+    raw = ''.join(raw)
+    # A trailing escape sequence (up to a partial \u escape) may not have fully arrived yet
+    for cut in range(min(5, len(raw)) + 1):
+        try:
+            value = json.loads(f'"{raw[:len(raw) - cut]}"')
+        except json.JSONDecodeError:
+            continue
+        # So may the low half of a \uXXXX\uXXXX surrogate pair: hold back the high half
+        if value and '\ud800' <= value[-1] <= '\udbff':
+            value = value[:-1]
+        return value
+    return None
+
+def analyze_property_with_ai(image_paths, persona, image_messages=None, image_digest=None, cache_checked=False):
+    """
+    Builds the marketing kit for persona and returns (content, fallback), where fallback
+    is True if the template content was used instead of the model's. Callers that have
+    already encoded or hashed the images can pass image_messages / image_digest to skip
+    re-reading them, and cache_checked=True if they already missed the result cache.
+    """
+    try:
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            print("OpenAI API key not found, using fallback")
+            return generate_fallback_content(persona), True
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+        # Serve repeat generations for the same photos and persona from the cache
+        cache_key = result_cache.make_key(image_paths, persona, AI_MODEL, PROMPT_VERSION, digest=image_digest)
+        cached = None if cache_checked else result_cache.get(cache_key)
+        if cached:
+            return cached, False
         
-        payload = {
-            "model": "gpt-4o", # Using the latest GPT-4o model for vision
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        *image_messages
-                    ]
-                }
-            ],
-            "max_tokens": 800 # Max tokens for the AI's text response
-        }
+        # Prepare images for API
+        if image_messages is None:
+            image_messages = build_image_messages(image_paths)
         
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=60 # Increased timeout for potentially more images
-        )
+        if not image_messages:
+            print("No valid images for AI analysis")
+            return generate_fallback_content(persona), True
+        
+        payload = build_vision_payload(image_messages, persona)
+        with metrics.stage('upstream_call'):
+            response = openai_client.post_chat_completion(payload, api_key)
+            if response.status_code == 200:
+                result = response.json()
         
         if response.status_code == 200:
-            result = response.json()
             ai_content = result['choices'][0]['message']['content']
             
-            # Format AI response into structured content
-            return {
-                "listing": f"<h2>Perfect Home for {persona}!</h2><p>{ai_content}</p>",
-                "social": f"<h3>Facebook Post:</h3><p>🏡 New listing perfect for {persona.lower()}! {ai_content[:150]}... #RealEstate #NewListing #{persona.replace(' ', '')}</p>",
-                "video": f"<h3>30-Second Video Script:</h3><p>Perfect property tour for {persona.lower()}. {ai_content[:200]}...</p>",
-                "points": f"<h3>Key Selling Points:</h3><ul><li><strong>Perfect for {persona}</strong></li><li><strong>Move-in Ready</strong></li><li><strong>Great Location</strong></li><li><strong>Unique Features</strong></li></ul>",
-                "analysis": f"AI analysis completed for {persona} based on actual property images."
-            }
+            with metrics.stage('response_formatting'):
+                try:
+                    sections = parse_ai_content(ai_content)
+                except ValueError as e:
+                    print(f"OpenAI API Error: {e}")
+                    return generate_fallback_content(persona), True
+                
+                content = format_ai_content(sections, persona)
+            result_cache.put(cache_key, content)
+            return content, False
         else:
             print(f"OpenAI API Error: {response.status_code}")
             print(f"OpenAI API Error details: {response.text}") 
-            return generate_fallback_content(persona)
+            return generate_fallback_content(persona), True
             
     except Exception as e:
         print(f"OpenAI API Error: {e}")
-        return generate_fallback_content(persona)
+        return generate_fallback_content(persona), True
+
+def analyze_property_for_personas(image_paths, personas):
+    """
+    Builds kits for several personas from one read and one encoding of the photos,
+    with the upstream calls running concurrently. Returns ({persona: content}, fallbacks)
+    where fallbacks is the set of personas that got the template content.
+    """
+    digest = result_cache.image_digest(image_paths)
+    results = {}
+    fallbacks = set()
+    for persona in personas:
+        cached = result_cache.get(result_cache.make_key(image_paths, persona, AI_MODEL, PROMPT_VERSION, digest=digest))
+        if cached:
+            results[persona] = cached
+    missing = [persona for persona in personas if persona not in results]
+    if not missing:
+        return results, fallbacks
+    
+    image_messages = build_image_messages(image_paths)
+    
+    # Interactive, like the single-persona path: paced by the per-call rate limiter only,
+    # and run on the interactive pool so it never waits for threads held by bulk batches
+    def generate(persona):
+        return analyze_property_with_ai(image_paths, persona, image_messages, digest, cache_checked=True)
+    
+    for index, outcome, error in batching.run(missing, generate, interactive=True):
+        persona = missing[index]
+        content, fallback = outcome if error is None else (generate_fallback_content(persona), True)
+        results[persona] = content
+        if fallback:
+            fallbacks.add(persona)
+    return results, fallbacks
+
+def analyze_property_with_ai_stream(image_paths, persona):
+    """
+    Streaming variant of analyze_property_with_ai. Yields ('delta', text) as tokens
+    arrive, then a single ('result', content) with the structured kit, or ('fallback', content)
+    if the template content was used instead.
+    """
+    try:
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            print("OpenAI API key not found, using fallback")
+            yield 'fallback', generate_fallback_content(persona)
+            return
+        
+        cache_key = result_cache.make_key(image_paths, persona, AI_MODEL, PROMPT_VERSION)
+        cached = result_cache.get(cache_key)
+        if cached:
+            yield 'result', cached
+            return
+        
+        image_messages = build_image_messages(image_paths)
+        if not image_messages:
+            print("No valid images for AI analysis")
+            yield 'fallback', generate_fallback_content(persona)
+            return
+        
+        payload = build_vision_payload(image_messages, persona)
+        payload["stream"] = True
+        # Timed to the end of the stream, since the reply arrives over its full length
+        upstream_started = time.perf_counter()
+        response = openai_client.post_chat_completion(payload, api_key, stream=True)
+        
+        if response.status_code != 200:
+            print(f"OpenAI API Error: {response.status_code}")
+            print(f"OpenAI API Error details: {response.text}")
+            yield 'fallback', generate_fallback_content(persona)
+            return
+        
+        # The model writes JSON, so only the decoded "listing" value is relayed as it grows
+        parts = []
+        sent = 0
+        with response:
+            for line in response.iter_lines():
+                line = line.decode('utf-8')
+                if not line.startswith('data: '):
+                    continue
+                data = line[len('data: '):]
+                if data == '[DONE]':
+                    break
+                delta = json.loads(data)['choices'][0]['delta'].get('content')
+                if not delta:
+                    continue
+                parts.append(delta)
+                listing = extract_partial_json_string(''.join(parts), 'listing')
+                if listing and len(listing) > sent:
+                    yield 'delta', listing[sent:]
+                    sent = len(listing)
+        metrics.observe_stage('upstream_call', time.perf_counter() - upstream_started)
+        
+        with metrics.stage('response_formatting'):
+            try:
+                sections = parse_ai_content(''.join(parts))
+            except ValueError as e:
+                print(f"OpenAI API Error: {e}")
+                sections = None
+            content = format_ai_content(sections, persona) if sections else generate_fallback_content(persona)
+        if sections:
+            result_cache.put(cache_key, content)
+        yield ('result' if sections else 'fallback'), content
+        
+    except Exception as e:
+        print(f"OpenAI API Error: {e}")
+        yield 'fallback', generate_fallback_content(persona)
 
 @app.route('/')
 def homepage():
@@ -455,34 +716,50 @@ document.getElementById("loginForm").addEventListener("submit", function(e) {
 @app.route('/api/upload', methods=['POST'])
 def upload_files():
     try:
-        if 'files' not in request.files:
+        # Parsing the form is where every file is streamed to disk and hashed (UploadRequest),
+        # so it is timed as its own stage; upload_index below only validates and moves the file
+        with metrics.stage('upload_receive'):
+            files = request.files.getlist('files')
+        if not files:
             return jsonify({'error': 'No files provided'}), 400
         
-        files = request.files.getlist('files')
-        if not files or files[0].filename == '':
+        if files[0].filename == '':
             return jsonify({'error': 'No files selected'}), 400
         
         uploaded_files = []
+        rejected_files = []
         
         for file in files[:10]:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4()}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+            if not file or not allowed_file(file.filename):
+                continue
+            filename = secure_filename(file.filename)
+            with metrics.stage('upload_index'):
+                if not file.stream.finish():
+                    rejected_files.append({'original_name': filename, 'error': file.stream.error})
+                    continue
                 
-                file.save(filepath)
-                uploaded_files.append({
-                    'filename': unique_filename,
-                    'original_name': filename,
-                    'path': filepath
-                })
+                try:
+                    stored_name, filepath, deduplicated = upload_store.commit(file.stream, app.config['UPLOAD_FOLDER'], get_ip_hash())
+                except upload_store.QuotaExceeded as e:
+                    rejected_files.append({'original_name': filename, 'error': str(e)})
+                    continue
+            # Build the downscaled copy now so generation doesn't pay for it
+            with metrics.stage('upload_preprocess'):
+                image_pipeline.prepare_for_vision(filepath)
+            uploaded_files.append({
+                'filename': stored_name,
+                'original_name': filename,
+                'path': filepath,
+                'deduplicated': deduplicated
+            })
         
         if not uploaded_files:
-            return jsonify({'error': 'No valid image files uploaded'}), 400
+            return jsonify({'error': 'No valid image files uploaded', 'rejected': rejected_files}), 400
         
         return jsonify({
             'success': True,
             'files': uploaded_files,
+            'rejected': rejected_files,
             'message': f'{len(uploaded_files)} files uploaded successfully'
         })
         
@@ -504,17 +781,21 @@ def generate_free_marketing_kit():
         if not persona or not file_paths:
             return jsonify({'error': 'Missing persona or images'}), 400
         
-        valid_paths = []
-        for path in file_paths:
-            full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
-            if os.path.exists(full_path):
-                valid_paths.append(full_path)
+        valid_paths = resolve_upload_paths(file_paths)
         
         if not valid_paths:
             return jsonify({'error': 'No valid image files found'}), 400
         
-        content = analyze_property_with_ai(valid_paths, persona)
-        mark_free_trial_used(ip_hash)
+        # Claim before generating so concurrent requests can't both spend the trial
+        if not claim_free_trial(ip_hash):
+            return jsonify({'error': 'Free trial already used'}), 403
+        
+        try:
+            content, fallback = analyze_property_with_ai(valid_paths, persona)
+        except Exception:
+            release_free_trial(ip_hash)
+            raise
+        record_generation(persona, fallback=fallback)
         
         return jsonify({
             'success': True,
@@ -530,18 +811,27 @@ def generate_marketing_kit():
     try:
         data = request.get_json()
         persona = data.get('persona')
+        personas = data.get('personas')
         file_paths = data.get('file_paths', [])
         
-        if not persona or not file_paths:
+        if not (persona or personas) or not file_paths:
             return jsonify({'error': 'Missing data'}), 400
         
-        valid_paths = []
-        for path in file_paths:
-            full_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
-            if os.path.exists(full_path):
-                valid_paths.append(full_path)
+        valid_paths = resolve_upload_paths(file_paths)
         
-        content = analyze_property_with_ai(valid_paths, persona)
+        # A list of personas returns {persona: kit}, built from one encoding of the photos
+        if personas:
+            if not isinstance(personas, list) or not all(isinstance(p, str) and p for p in personas):
+                return jsonify({'error': 'personas must be a list of persona names'}), 400
+            personas = list(dict.fromkeys(personas))
+            if len(personas) > MAX_PERSONAS:
+                return jsonify({'error': f'At most {MAX_PERSONAS} personas per request'}), 400
+            content, fallbacks = analyze_property_for_personas(valid_paths, personas)
+            for name in personas:
+                record_generation(name, fallback=name in fallbacks)
+        else:
+            content, fallback = analyze_property_with_ai(valid_paths, persona)
+            record_generation(persona, fallback=fallback)
         
         return jsonify({
             'success': True,
@@ -552,13 +842,208 @@ def generate_marketing_kit():
     except Exception as e:
         return jsonify({'error': f'Generation failed: {str(e)}'}), 500
 
+# Streaming generation: listing text is relayed as Server-Sent Events while the model writes it
+@app.route('/api/generate-stream', methods=['POST'])
+def generate_marketing_kit_stream():
+    try:
+        data = request.get_json()
+        persona = data.get('persona')
+        file_paths = data.get('file_paths', [])
+        
+        if not persona or not file_paths:
+            return jsonify({'error': 'Missing data'}), 400
+        
+        valid_paths = resolve_upload_paths(file_paths)
+        generation_id = str(uuid.uuid4())
+        user = get_user_key()
+        
+        def events():
+            for kind, value in analyze_property_with_ai_stream(valid_paths, persona):
+                if kind == 'delta':
+                    yield f"event: delta\ndata: {json.dumps({'text': value})}\n\n"
+                else:
+                    record_generation(persona, user, fallback=kind == 'fallback')
+                    yield f"event: result\ndata: {json.dumps({'success': True, 'content': value, 'generation_id': generation_id})}\n\n"
+        
+        return Response(events(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Generation failed: {str(e)}'}), 500
+
+# Bulk generation: many (file_paths, persona) jobs in one request, results streamed as NDJSON.
+# A large batch streams for minutes while it is paced by the token budget, and holds a
+# worker thread the whole time, so only serve it from threaded or async workers (gunicorn
+# --worker-class gthread/gevent, with --timeout above the longest batch). A sync worker
+# is killed by its timeout mid-stream; submit listings through /api/jobs there instead.
+@app.route('/api/generate-batch', methods=['POST'])
+def generate_marketing_kit_batch():
+    try:
+        data = request.get_json()
+        items = data.get('jobs')
+        
+        if not items or not isinstance(items, list):
+            return jsonify({'error': 'Missing jobs'}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'At most {BATCH_MAX_ITEMS} jobs per batch'}), 400
+        
+        user = get_user_key()
+        listings = []
+        for item in items:
+            item = item if isinstance(item, dict) else {}
+            listings.append({'paths': resolve_upload_paths(item.get('file_paths') or []), 'persona': item.get('persona')})
+        
+        # Every distinct photo starts encoding now, in parallel with the first upstream calls
+        encoding = batching.encode_images(path for listing in listings for path in listing['paths'])
+        has_api_key = bool(os.getenv('OPENAI_API_KEY'))
+        
+        def tokens_needed(listing):
+            # Runs on the streaming thread before the listing is handed to a generation
+            # thread, which is where the batch waits for token budget. Cached and invalid
+            # listings cost nothing.
+            paths, persona = listing['paths'], listing['persona']
+            if not persona or not paths:
+                return 0
+            listing['digest'] = result_cache.image_digest(paths)
+            listing['cached'] = result_cache.get(
+                result_cache.make_key(paths, persona, AI_MODEL, PROMPT_VERSION, digest=listing['digest'])
+            )
+            if listing['cached'] or not has_api_key:
+                return 0
+            return estimate_request_tokens(len(paths))
+        
+        def generate(listing):
+            paths, persona = listing['paths'], listing['persona']
+            if not persona or not paths:
+                raise ValueError('Missing persona or no valid image files found')
+            if listing['cached']:
+                content, fallback = listing['cached'], False
+            else:
+                image_messages = build_image_messages(paths, batching.encoded_urls(encoding, paths))
+                content, fallback = analyze_property_with_ai(paths, persona, image_messages, listing['digest'],
+                                                             cache_checked=True)
+            record_generation(persona, user, fallback)
+            return content
+        
+        def lines():
+            completed = 0
+            for index, content, error in batching.run(listings, generate, cost=tokens_needed):
+                completed += 1
+                if error is not None:
+                    yield json.dumps({'index': index, 'success': False, 'error': str(error)}) + '\n'
+                else:
+                    yield json.dumps({'index': index, 'success': True, 'content': content,
+                                      'generation_id': str(uuid.uuid4())}) + '\n'
+            yield json.dumps({'done': True, 'count': completed}) + '\n'
+        
+        return Response(lines(), mimetype='application/x-ndjson', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Batch generation failed: {str(e)}'}), 500
+
+def generate_job_content(image_paths, persona, user):
+    content, fallback = analyze_property_with_ai(image_paths, persona)
+    record_generation(persona, user, fallback)
+    return content
+
+# Asynchronous generation: submit returns a job id at once and the kit is built in the background
+@app.route('/api/jobs', methods=['POST'])
+def submit_generation_job():
+    try:
+        data = request.get_json()
+        persona = data.get('persona')
+        file_paths = data.get('file_paths', [])
+        
+        if not persona or not file_paths:
+            return jsonify({'error': 'Missing data'}), 400
+        
+        valid_paths = resolve_upload_paths(file_paths)
+        if not valid_paths:
+            return jsonify({'error': 'No valid image files found'}), 400
+        
+        job_id = jobs.submit(generate_job_content, valid_paths, persona, get_user_key())
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': f'/api/jobs/{job_id}',
+            'events_url': f'/api/jobs/{job_id}/events'
+        }), 202
+        
+    except jobs.QueueFull:
+        return jsonify({'error': 'Too many generations in progress, please retry shortly'}), 503
+    except Exception as e:
+        return jsonify({'error': f'Job submission failed: {str(e)}'}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_generation_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'success': True, **job})
+
+# Holds a worker thread for as long as the stream is open, so only serve it from threaded
+# or async workers (gunicorn --worker-class gthread/gevent). Behind sync workers, clients
+# should poll status_url instead. Streams end after JOB_EVENTS_MAX_SECONDS with a timeout
+# event; the client then reconnects or falls back to polling.
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_generation_job(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def events():
+        last_status = None
+        deadline = time.time() + JOB_EVENTS_MAX_SECONDS
+        while time.time() < deadline:
+            job = jobs.get(job_id)
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            if jobs.is_finished(job):
+                return
+            time.sleep(JOB_EVENTS_POLL_INTERVAL)
+        yield "event: timeout\ndata: {}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/app')
 def app_interface():
     return render_template('index.html')
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    path = upload_store.storage_path(app.config['UPLOAD_FOLDER'], filename)
+    if not path or not os.path.isfile(path):
+        return jsonify({'error': 'Not found'}), 404
+    
+    width = request.args.get('w', type=int)
+    if width is not None:
+        if width not in image_pipeline.THUMBNAIL_WIDTHS:
+            return jsonify({'error': f'Unsupported width, use one of {list(image_pipeline.THUMBNAIL_WIDTHS)}'}), 400
+        try:
+            path = image_pipeline.ensure_thumbnail(path, width)
+        except Exception as e:
+            print(f"Thumbnail error for {filename}: {e}")
+            return jsonify({'error': 'Could not create thumbnail'}), 415
+    
+    # Content-addressed files never change, so their hash is a strong ETag and they can be cached forever
+    content_hash = upload_store.content_hash(filename)
+    if content_hash:
+        etag = f"{content_hash}-w{width}" if width else content_hash
+        response = send_from_directory(
+            os.path.abspath(os.path.dirname(path)), os.path.basename(path),
+            conditional=True, etag=etag, max_age=365 * 24 * 3600
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+    
+    return send_from_directory(os.path.abspath(os.path.dirname(path)), os.path.basename(path), conditional=True)
 
 # New routes for the feature pages
 @app.route('/brand_lab')
@@ -605,12 +1090,20 @@ def save_brand_profile():
         slogan = data.get('slogan')
         tone = data.get('tone')
         
-        print(f"Received Brand Profile: Slogan='{slogan}', Tone='{tone}'")
+        datastore.get_store().save_brand_profile(get_user_key(), slogan, tone)
         
         return jsonify({'success': True, 'message': 'Brand profile saved successfully!'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/get_brand_profile', methods=['GET'])
+def get_brand_profile():
+    try:
+        profile = datastore.get_store().get_brand_profile(get_user_key())
+        return jsonify({'success': True, 'data': profile})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 # API for scheduling social posts
 @app.route('/api/schedule_social_post', methods=['POST'])
 def schedule_social_post():
@@ -619,9 +1112,18 @@ def schedule_social_post():
         content = data.get('content')
         date = data.get('date')
         
-        print(f"Received Social Post: Content='{content}', Date='{date}'")
+        if not content or not date:
+            return jsonify({'success': False, 'error': 'Missing content or date'}), 400
+        
+        try:
+            due_at = datastore.parse_due_at(date)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid date; use YYYY-MM-DD or an ISO 8601 datetime'}), 400
         
-        return jsonify({'success': True, 'message': 'Social post scheduled successfully!'})
+        post_id = datastore.get_store().add_social_post(get_user_key(), content, date, due_at)
+        scheduler.notify(post_id, due_at)
+        
+        return jsonify({'success': True, 'id': post_id, 'message': 'Social post scheduled successfully!'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -634,37 +1136,47 @@ def add_nurture_lead():
         contact = data.get('contact')
         lead_type = data.get('type')
         
-        print(f"Received Lead: Name='{name}', Contact='{contact}', Type='{lead_type}'")
+        if not name or not contact:
+            return jsonify({'success': False, 'error': 'Missing name or contact'}), 400
+        
+        lead_id = datastore.get_store().add_lead(get_user_key(), name, contact, lead_type)
         
-        return jsonify({'success': True, 'message': 'Lead added and nurturing initiated!'})
+        return jsonify({'success': True, 'id': lead_id, 'message': 'Lead added and nurturing initiated!'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/get_social_posts', methods=['GET'])
 def get_social_posts():
     try:
-        # In a real application, you would fetch posts from your database here.
-        # For now, we return mock data so the page works.
-        mock_posts = [
-            {'content': 'Check out this stunning new listing! Perfect for first-time homebuyers.', 'date': '2025-08-01'},
-            {'content': 'Open house this Saturday at 2 PM. Don\'t miss out!', 'date': '2025-08-05'},
-            {'content': 'Just sold! We can help you find your dream home too. Contact us!', 'date': '2025-08-10'}
-        ]
-        return jsonify(mock_posts)
+        limit, offset = datastore.clamp_page(request.args.get('limit'), request.args.get('offset'))
+        posts = datastore.get_store().list_social_posts(get_user_key(), limit, offset)
+        return jsonify({'success': True, 'data': posts, 'limit': limit, 'offset': offset})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/get_leads', methods=['GET'])
 def get_leads():
     try:
-        # In a real application, you would fetch leads from your database here.
-        # For now, we return mock data.
-        mock_leads = [
-            {'name': 'John Doe', 'contact': 'john.d@example.com', 'type': 'Growing Family'},
-            {'name': 'Jane Smith', 'contact': '555-123-4567', 'type': 'Luxury Seeker'},
-            {'name': 'Sam Wilson', 'contact': 'sam.w@example.com', 'type': 'Downsizing Retirees'}
-        ]
-        return jsonify(mock_leads)
+        limit, _ = datastore.clamp_page(request.args.get('limit'), 0)
+        since = request.args.get('since')
+        until = request.args.get('until')
+        try:
+            leads, next_cursor = datastore.get_store().list_leads(
+                get_user_key(), limit,
+                cursor=request.args.get('cursor'),
+                lead_type=request.args.get('type'),
+                since=datastore.parse_due_at(since, default_hour=0) if since else None,
+                until=datastore.parse_due_at(until, default_hour=0) if until else None,
+                search=request.args.get('q')
+            )
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
+        # Pages are cheap to build but not to ship; let the browser revalidate with If-None-Match
+        response = jsonify({'success': True, 'data': leads, 'limit': limit, 'next_cursor': next_cursor})
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.add_etag()
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -687,22 +1199,28 @@ def generate_open_house_kit():
 @app.route('/api/get_performance_insights', methods=['GET'])
 def get_performance_insights():
     try:
-        # In a real application, this would fetch data from a database
-        # and potentially use AI to generate insights.
-        # For now, return mock data.
-        mock_data = {
-            "totalListings": 15,
-            "avgEngagement": "7.2%",
-            "topPersona": "Growing Family",
-            "aiSuggestionsCount": 5,
-            "insights": [
-                "Properties with modern kitchens received 3x more comments last month.",
-                "Emotional posts generated 2x more direct messages.",
-                "Listings with virtual tours had a 15% higher click-through rate.",
-                "Consider targeting 'Downsizing Retirees' for properties with single-story layouts."
-            ]
+        summary = datastore.get_store().get_performance_summary(get_user_key())
+        # Written suggestions are still static; the headline numbers come from recorded activity
+        insights = [
+            "Properties with modern kitchens received 3x more comments last month.",
+            "Emotional posts generated 2x more direct messages.",
+            "Listings with virtual tours had a 15% higher click-through rate.",
+            "Consider targeting 'Downsizing Retirees' for properties with single-story layouts."
+        ]
+        data = {
+            "totalListings": summary['totalListings'],
+            "fallbackRate": summary['fallbackRate'],
+            "topPersona": summary['topPersona'] or "N/A",
+            "topPersonas": summary['topPersonas'],
+            "totalPosts": summary['totalPosts'],
+            "publishedPosts": summary['publishedPosts'],
+            "totalLeads": summary['totalLeads'],
+            "recent": summary['recent'],
+            "recentDays": summary['recentDays'],
+            "aiSuggestionsCount": len(insights),
+            "insights": insights
         }
-        return jsonify({'success': True, 'message': 'Insights loaded successfully!', 'data': mock_data})
+        return jsonify({'success': True, 'message': 'Insights loaded successfully!', 'data': data})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -713,19 +1231,45 @@ def add_team_member():
         data = request.get_json()
         name = data.get('name')
         email = data.get('email')
+        
+        if not name or not email:
+            return jsonify({'success': False, 'error': 'Missing name or email'}), 400
+        
+        # Invitations and account creation for team members are not handled yet
+        datastore.get_store().add_team_member(get_user_key(), name, email)
+        
+        return jsonify({'success': True, 'message': 'Team member added successfully!'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        # In a real application, you would save this team member data to a database
-        # and handle user creation/invitation.
-        print(f"Received new Team Member: Name='{name}', Email='{email}'")
+@app.route('/api/get_team_members', methods=['GET'])
+def get_team_members():
+    try:
+        limit, offset = datastore.clamp_page(request.args.get('limit'), request.args.get('offset'))
+        members = datastore.get_store().list_team_members(get_user_key(), limit, offset)
+        return jsonify({'success': True, 'data': members, 'limit': limit, 'offset': offset})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-        return jsonify({'success': True, 'message': 'Team member added successfully!'})
+@app.route('/api/storage_stats', methods=['GET'])
+def storage_stats():
+    try:
+        return jsonify({'success': True, 'data': upload_store.stats(owner=get_ip_hash())})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 @app.route('/health')
 def health_check():
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.now().isoformat(),
+        'upstream': upstream_guard.breaker.status()
+    })
 
 @app.errorhandler(404)
 def not_found(e):
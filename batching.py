@@ -0,0 +1,138 @@
+# batching.py
+# Shared machinery for bulk generation: image encoding on a process pool, a
+# tokens-per-minute budget for upstream calls, and bounded-concurrency fan-out.
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import image_pipeline
+import upstream_guard
+
+# Every gunicorn worker starts its own encoder pool, so the default splits the CPUs between
+# the WEB_CONCURRENCY workers (gunicorn's own worker-count variable) instead of giving each
+# worker one process per CPU
+WEB_WORKERS = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+ENCODE_PROCESSES = int(os.getenv('BATCH_ENCODE_PROCESSES', min(4, max(1, (os.cpu_count() or 2) // WEB_WORKERS))))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 8))
+# Threads for interactive fan-out (one request, several personas), kept apart from bulk batches
+INTERACTIVE_CONCURRENCY = int(os.getenv('INTERACTIVE_CONCURRENCY', 8))
+# Tokens-per-minute budget for bulk upstream calls; size it to the account's TPM limit
+TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TPM_BUDGET', 30000))
+# How often a batch waiting for budget re-checks it
+PACING_POLL = 0.5
+
+
+# Shared with every other worker on the host through upstream_guard's store
+budget = upstream_guard.TokenBucket('openai_tokens', TOKENS_PER_MINUTE)
+
+# Generation threads are shared by all batches in the process, which bounds the total
+# number of upstream calls in flight no matter how many batches are running
+_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+# A separate pool so an interactive request never queues behind a bulk batch's backlog
+_interactive_executor = ThreadPoolExecutor(max_workers=INTERACTIVE_CONCURRENCY, thread_name_prefix='interactive')
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def _get_encoder():
+    global _encoder
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                # spawn, not fork: the web worker has live threads and sockets
+                _encoder = ProcessPoolExecutor(max_workers=ENCODE_PROCESSES,
+                                               mp_context=multiprocessing.get_context('spawn'))
+    return _encoder
+
+
+def _discard_encoder(encoder):
+    # A worker process died; the next batch starts a fresh pool
+    global _encoder
+    with _encoder_lock:
+        if _encoder is encoder:
+            _encoder = None
+    encoder.shutdown(wait=False)
+
+
+def encode_images(image_paths):
+    """
+    Starts encoding every image on the process pool. Returns {path: future}.
+    """
+    image_paths = set(image_paths)
+    encoder = _get_encoder()
+    try:
+        return {path: encoder.submit(image_pipeline.encode_for_vision, path) for path in image_paths}
+    except BrokenProcessPool:
+        _discard_encoder(encoder)
+        encoder = _get_encoder()
+        return {path: encoder.submit(image_pipeline.encode_for_vision, path) for path in image_paths}
+
+
+def encoded_urls(futures, image_paths):
+    """
+    Waits for the data URLs of image_paths, encoding in this thread if the pool failed.
+    """
+    urls = {}
+    for path in image_paths:
+        try:
+            urls[path] = futures[path].result()
+        except Exception as e:
+            print(f"Image encoding pool error for {path}: {e}")
+            urls[path] = image_pipeline.encode_for_vision(path)
+    return urls
+
+
+def run(items, work, interactive=False, cost=None):
+    """
+    Runs work(item) for every item on the shared generation threads and yields
+    (index, result, error) in completion order. Unstarted work is cancelled if the
+    consumer stops early (e.g. the client disconnected). interactive=True uses the
+    interactive pool instead of the bulk one.
+
+    With cost, cost(item) tokens are taken from budget on the calling thread before the
+    item is handed to a thread, and at most BATCH_CONCURRENCY items are handed over at a
+    time, so generation threads only ever wait on upstream calls and a batch waiting
+    for budget holds none of them.
+    """
+    executor = _interactive_executor if interactive else _executor
+    limit = BATCH_CONCURRENCY if cost else None
+    waiting = deque([index, item, None] for index, item in enumerate(items))
+    futures = {}
+    try:
+        while waiting or futures:
+            paced = False
+            while waiting and (limit is None or len(futures) < limit):
+                entry = waiting[0]
+                index, item, amount = entry
+                if cost and amount is None:
+                    try:
+                        amount = entry[2] = cost(item)
+                    except Exception as e:
+                        waiting.popleft()
+                        yield index, None, e
+                        continue
+                if amount and not budget.acquire(amount, max_wait=0):
+                    paced = True
+                    break
+                waiting.popleft()
+                futures[executor.submit(work, item)] = index
+            if not futures:
+                time.sleep(PACING_POLL)
+                continue
+            done, _ = wait(futures, timeout=PACING_POLL if paced else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield index, None, e
+                else:
+                    yield index, result, None
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,538 @@
+# bench.py
+# Load-test harness for the upload and generation paths.
+#
+# Starts a mock OpenAI chat-completions server and the app under gunicorn in a scratch
+# directory, drives each scenario at each concurrency level, and writes the results
+# (RPS, latency percentiles, worker memory, upstream traffic) as JSON:
+#
+#   python bench.py --concurrency 1,8,32 --duration 20 --latency 1.5 --error-rate 0.02
+#   python bench.py --output new.json --compare bench_results.json
+#
+# With --compare the run exits non-zero if any scenario's p95 or RPS regressed by more
+# than --tolerance against the earlier results file.
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('upload', 'generate', 'generate-free', 'uploads')
+PERSONAS = ("First-Time Homebuyers", "Luxury Seeker", "Growing Family", "Downsizing Retirees")
+
+MOCK_KIT = json.dumps({
+    "listing": "Sunlit open-plan living with oak floors, a renovated kitchen and a private garden. " * 8,
+    "social": "Just listed: bright, renovated and ready to move in. #RealEstate #JustListed",
+    "video": "Step inside to warm oak floors and a kitchen made for gathering. " * 4,
+    "points": ["Renovated kitchen", "Private garden", "Oak floors", "Move-in ready"],
+    "analysis": "Move-in ready with room to grow."
+})
+
+
+# --- Mock upstream ---
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.stats['requests'] += 1
+            server.stats['bytes'] += len(body) + len(str(self.headers))
+        time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.stats['errors_injected'] += 1
+            self._send(503, b'{"error": {"message": "mock overload"}}', 'application/json')
+            return
+
+        if b'"stream": true' in body:
+            chunks = [MOCK_KIT[i:i + 40] for i in range(0, len(MOCK_KIT), 40)]
+            events = ''.join(
+                f"data: {json.dumps({'choices': [{'delta': {'content': chunk}}]})}\n\n" for chunk in chunks
+            ) + 'data: [DONE]\n\n'
+            self._send(200, events.encode(), 'text/event-stream')
+        else:
+            reply = {'choices': [{'message': {'content': MOCK_KIT}}]}
+            self._send(200, json.dumps(reply).encode(), 'application/json')
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_mock_openai(latency, jitter, error_rate):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockOpenAIHandler)
+    server.daemon_threads = True
+    server.latency, server.jitter, server.error_rate = latency, jitter, error_rate
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'bytes': 0, 'errors_injected': 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- App under test ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(workdir, mock_url, args):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_CHAT_COMPLETIONS_URL': mock_url,
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'prometheus'),
+        'PYTHONPATH': REPO_DIR,
+        # Sizes each worker's share of the image encoding processes
+        'WEB_CONCURRENCY': str(args.workers),
+    })
+    # Measure the app rather than the local rate limiter, unless the caller set one
+    env.setdefault('OPENAI_RPM_LIMIT', '1000000')
+    # Every bench upload comes from 127.0.0.1, i.e. one client, so lift the per-client quota
+    env.setdefault('UPLOAD_QUOTA_BYTES', str(1024 ** 4))
+    if not args.warm_cache:
+        # Every generation misses the result cache and goes upstream
+        env['RESULT_CACHE_MAX_AGE'] = '0'
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'])
+
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app',
+         '--bind', f'127.0.0.1:{port}',
+         '--workers', str(args.workers),
+         '--worker-class', 'gthread',
+         '--threads', str(args.threads),
+         '--timeout', '120',
+         '--log-level', 'warning'],
+        cwd=workdir, env=env,
+        stdout=open(os.path.join(workdir, 'app.log'), 'wb'), stderr=subprocess.STDOUT
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup, see {workdir}/app.log")
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("App did not become healthy within 60s")
+
+
+def worker_pids(master_pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, so split after its closing paren
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == master_pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler:
+    """
+    Records the peak RSS of every gunicorn worker while a level runs (Linux only).
+    """
+
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peaks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            for pid in worker_pids(self.master_pid):
+                rss = rss_bytes(pid)
+                if rss is not None:
+                    self.peaks[pid] = max(self.peaks.get(pid, 0), rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def summary(self):
+        if not self.peaks:
+            return None
+        peaks = list(self.peaks.values())
+        return {
+            'workers': len(peaks),
+            'peak_rss_mb_max': round(max(peaks) / 2 ** 20, 1),
+            'peak_rss_mb_mean': round(sum(peaks) / len(peaks) / 2 ** 20, 1)
+        }
+
+
+def read_counter(base_url, name):
+    try:
+        text = requests.get(f'{base_url}/metrics', timeout=5).text
+    except requests.RequestException:
+        return None
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + ' ') or line.startswith(name + '{'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+# --- Scenarios ---
+
+def make_jpeg(size, seed):
+    width, height = size
+    img = Image.new('RGB', (width, height), (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256))
+    # A few shapes so the encoder has real detail to compress
+    for i in range(16):
+        box = (i * width // 16, 0, (i + 1) * width // 16, height // (1 + i % 4))
+        img.paste(((seed + i) * 29 % 256, i * 15 % 256, 200), box)
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class Scenario:
+
+    def __init__(self, base_url, args):
+        self.base_url = base_url
+        self.args = args
+        self.images = [make_jpeg(args.image_size, seed) for seed in range(8)]
+        self._sequence = itertools.count()
+        self._unique = itertools.count()
+
+    def unique_image(self):
+        # Bytes after the JPEG end marker are ignored by decoders but change the content
+        # hash, so every upload is stored rather than deduplicated
+        n = next(self._unique)
+        return self.images[n % len(self.images)] + f'bench-{n}'.encode()
+
+    def upload(self, session, count):
+        files = [('files', (f'bench{i}.jpg', self.unique_image(), 'image/jpeg')) for i in range(count)]
+        response = session.post(f'{self.base_url}/api/upload', files=files, timeout=120)
+        response.raise_for_status()
+        return [item['filename'] for item in response.json()['files']]
+
+    def setup(self, session):
+        pass
+
+    def request(self, session):
+        raise NotImplementedError
+
+
+class UploadScenario(Scenario):
+
+    def request(self, session):
+        files = [('files', ('bench.jpg', self.unique_image(), 'image/jpeg'))]
+        return session.post(f'{self.base_url}/api/upload', files=files, timeout=120)
+
+
+class GenerateScenario(Scenario):
+
+    def setup(self, session):
+        self.listings = [self.upload(session, self.args.images) for _ in range(8)]
+
+    def request(self, session):
+        n = next(self._sequence)
+        return session.post(f'{self.base_url}/api/generate', json={
+            'file_paths': self.listings[n % len(self.listings)],
+            'persona': PERSONAS[n % len(PERSONAS)]
+        }, timeout=120)
+
+
+class GenerateFreeScenario(GenerateScenario):
+
+    def request(self, session):
+        # Each request comes from a new client address so the one-trial rule never rejects it
+        n = next(self._sequence)
+        client_ip = f'10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}'
+        return session.post(f'{self.base_url}/api/generate-free', json={
+            'file_paths': self.listings[n % len(self.listings)],
+            'persona': PERSONAS[n % len(PERSONAS)]
+        }, headers={'X-Forwarded-For': client_ip}, timeout=120)
+
+
+class ServeUploadsScenario(Scenario):
+
+    def setup(self, session):
+        self.filenames = self.upload(session, 4)
+
+    def request(self, session):
+        # Alternate full-size originals and gallery thumbnails
+        n = next(self._sequence)
+        query = '?w=320' if n % 2 else ''
+        return session.get(f'{self.base_url}/uploads/{self.filenames[n % len(self.filenames)]}{query}', timeout=120)
+
+
+SCENARIO_CLASSES = {
+    'upload': UploadScenario,
+    'generate': GenerateScenario,
+    'generate-free': GenerateFreeScenario,
+    'uploads': ServeUploadsScenario,
+}
+
+
+# --- Load generation ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def drive(scenario, concurrency, duration):
+    """
+    Runs scenario.request in concurrency closed-loop threads for duration seconds.
+    Returns (latencies_s, status_counts, response_bytes, wall_s).
+    """
+    latencies = []
+    statuses = {}
+    received = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def loop():
+        session = requests.Session()
+        local_latencies, local_statuses, local_bytes = [], {}, 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = scenario.request(session)
+                status = str(response.status_code)
+                local_bytes += len(response.content)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            local_latencies.append(time.perf_counter() - started)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+            received[0] += local_bytes
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, received[0], time.perf_counter() - started
+
+
+def run_level(name, scenario, concurrency, args, app_process, base_url, mock):
+    with mock.lock:
+        upstream_before = dict(mock.stats)
+    fallbacks_before = read_counter(base_url, 'auramarkt_fallbacks_total')
+
+    with MemorySampler(app_process.pid) as sampler:
+        latencies, statuses, received, wall = drive(scenario, concurrency, args.duration)
+
+    with mock.lock:
+        upstream = {key: mock.stats[key] - upstream_before[key] for key in mock.stats}
+    fallbacks_after = read_counter(base_url, 'auramarkt_fallbacks_total')
+
+    latencies.sort()
+    requests_done = len(latencies)
+    errors = sum(count for status, count in statuses.items() if not status.startswith('2'))
+    ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'duration_s': round(wall, 2),
+        'requests': requests_done,
+        'errors': errors,
+        'status_counts': statuses,
+        'rps': round(requests_done / wall, 2) if wall else 0.0,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / requests_done) if requests_done else None,
+            'p50': ms(percentile(latencies, 0.50)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'response_bytes': received,
+        'upstream': {
+            'requests': upstream['requests'],
+            'bytes_sent': upstream['bytes'],
+            'bytes_per_request': round(upstream['bytes'] / upstream['requests']) if upstream['requests'] else 0,
+            'errors_injected': upstream['errors_injected'],
+        },
+        'fallbacks': (fallbacks_after - fallbacks_before
+                      if fallbacks_before is not None and fallbacks_after is not None else None),
+        'memory': sampler.summary(),
+    }
+
+
+# --- Reporting ---
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_result(result):
+    latency = result['latency_ms']
+    memory = result['memory'] or {}
+    print(f"{result['scenario']:<14} c={result['concurrency']:<4} {result['rps']:>8.1f} rps  "
+          f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  "
+          f"errors={result['errors']}  upstream={result['upstream']['requests']} req/"
+          f"{result['upstream']['bytes_sent'] / 2 ** 20:.1f}MB  "
+          f"rss={memory.get('peak_rss_mb_max', '-')}MB")
+
+
+def compare(baseline_path, results, tolerance):
+    """
+    Prints per-level changes against baseline_path. Returns the list of regressions.
+    """
+    with open(baseline_path) as f:
+        baseline = {(r['scenario'], r['concurrency']): r for r in json.load(f)['results']}
+    regressions = []
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for result in results:
+        old = baseline.get((result['scenario'], result['concurrency']))
+        if old is None or not old['rps'] or not old['latency_ms']['p95'] or not result['latency_ms']['p95']:
+            continue
+        rps_change = result['rps'] / old['rps'] - 1
+        p95_change = result['latency_ms']['p95'] / old['latency_ms']['p95'] - 1
+        flag = ''
+        if rps_change < -tolerance or p95_change > tolerance:
+            regressions.append(result)
+            flag = '  REGRESSION'
+        print(f"{result['scenario']:<14} c={result['concurrency']:<4} rps {rps_change:+.1%}  p95 {p95_change:+.1%}{flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the upload and generation paths against a mock OpenAI.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated client concurrency levels')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per scenario and level')
+    parser.add_argument('--warmup', type=float, default=3, help='unrecorded seconds before each scenario')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=16, help='threads per gunicorn worker')
+    parser.add_argument('--latency', type=float, default=1.0, help='mock upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.2, help='standard deviation of the mock latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of mock calls answered with 503')
+    parser.add_argument('--images', type=int, default=4, help='photos per listing for generation scenarios')
+    parser.add_argument('--image-size', default='1600x1200', help='WIDTHxHEIGHT of generated photos')
+    parser.add_argument('--warm-cache', action='store_true', help='let repeat generations hit the result cache')
+    parser.add_argument('--seed', type=int, default=1, help='seed for mock latency and errors')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed RPS drop / p95 rise for --compare')
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    args.image_size = tuple(int(side) for side in args.image_size.lower().split('x'))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='auramarkt-bench-')
+    mock = start_mock_openai(args.latency, args.jitter, args.error_rate)
+    mock_url = f'http://127.0.0.1:{mock.server_address[1]}/v1/chat/completions'
+    app_process, base_url = start_app(workdir, mock_url, args)
+    print(f"App at {base_url} ({args.workers} workers x {args.threads} threads), scratch dir {workdir}")
+
+    results = []
+    try:
+        for name in args.scenarios:
+            scenario = SCENARIO_CLASSES[name](base_url, args)
+            scenario.setup(requests.Session())
+            if args.warmup:
+                drive(scenario, 1, args.warmup)
+            for concurrency in args.concurrency:
+                result = run_level(name, scenario, concurrency, args, app_process, base_url, mock)
+                print_result(result)
+                results.append(result)
+    finally:
+        app_process.terminate()
+        try:
+            app_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            app_process.kill()
+        mock.shutdown()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare and compare(args.compare, results, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,104 +3,525 @@
 
 import asyncio
 import json
-from playwright.async_api import async_playwright
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+import metrics
+import scrape_cache
 
-async def scrape_public_profile(profile_url: str):
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36'
+
+FEED_SELECTOR = 'div[role="feed"]'
+TARGET_POSTS = 5
+MIN_POST_LENGTH = 20
+
+# Hard limit on one profile scrape, from navigation to the last post
+SCRAPE_BUDGET_MS = 60000
+# Limit on the scroll-and-collect phase, and on waiting for one scroll to load more posts
+COLLECT_BUDGET_MS = 15000
+SCROLL_WAIT_MS = 4000
+MAX_SCROLLS = 6
+# Browser contexts used for refreshing stale cache entries in the background
+REFRESH_CONTEXTS = 2
+
+# Lean mode: the scraper only reads text, so everything below is dropped before it is fetched
+BLOCKED_RESOURCE_TYPES = {'image', 'media', 'font', 'imageset', 'texttrack', 'manifest'}
+BLOCKED_HOST_SUFFIXES = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'connect.facebook.net',
+    'scorecardresearch.com', 'hotjar.com', 'segment.io', 'newrelic.com', 'nr-data.net'
+)
+LEAN_VIEWPORT = {'width': 1024, 'height': 768}
+LEAN_BROWSER_ARGS = [
+    "--disable-gpu",
+    "--disable-dev-shm-usage",
+    "--disable-extensions",
+    "--mute-audio",
+    "--blink-settings=imagesEnabled=false",
+    "--disk-cache-size=1048576",
+]
+
+# Number of feed children, how many of them already contain a post long enough to keep,
+# and whether the newest post from a previous scrape has been reached
+COUNT_POSTS_JS = '''([feedSelector, minLength, knownPost]) => {
+    const children = Array.from(document.querySelectorAll(`${feedSelector} > div`));
+    const texts = children.map(child => {
+        const message = child.querySelector('div[data-ad-preview="message"]');
+        return message ? message.innerText.trim() : '';
+    });
+    return {
+        children: children.length,
+        qualifying: texts.filter(text => text.length > minLength).length,
+        reachedKnown: knownPost !== null && texts.includes(knownPost)
+    };
+}'''
+
+# Reads the bio and the message text of every feed child in a single page evaluation.
+# Children without a message (ads, suggestions, loaders) come back as null.
+BIO_SELECTOR = 'div[data-pagelet="ProfileTimeline"] div.x1b0d499.x1d69dk1'
+EXTRACT_TEXT_JS = '''([feedSelector, bioSelector]) => {
+    const bio = document.querySelector(bioSelector);
+    const posts = Array.from(document.querySelectorAll(`${feedSelector} > div`)).map(child => {
+        const message = child.querySelector('div[data-ad-preview="message"]');
+        return message ? message.innerText : null;
+    });
+    return { bio: bio ? bio.innerText : null, posts };
+}'''
+
+FEED_GREW_JS = '''([feedSelector, previousCount]) =>
+    document.querySelectorAll(`${feedSelector} > div`).length > previousCount'''
+
+
+# --- Instrumentation ---
+# Phase timings and counters go to the Prometheus metrics served on the app's /metrics
+
+
+def _record_span(phase, elapsed_ms, status):
+    metrics.SCRAPE_PHASE_LATENCY.labels(phase, status).observe(elapsed_ms / 1000)
+
+
+def _count(name, amount=1):
+    metrics.SCRAPER_EVENTS.labels(name).inc(amount)
+
+
+class ScrapeTrace:
     """
-    Launches a browser and uses advanced techniques to scrape a public Facebook profile.
+    Timed spans for one scrape. Each span is also recorded in the Prometheus metrics.
     """
-    scraped_data = {
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, phase=None):
+        phase = phase or name
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except PlaywrightTimeoutError:
+            status = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.spans.append({'name': name, 'phase': phase, 'ms': round(elapsed_ms, 1), 'status': status})
+            _record_span(phase, elapsed_ms, status)
+            if status == 'timeout':
+                _count('selector_timeouts')
+
+    def summary(self):
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'timeouts': sum(1 for span in self.spans if span['status'] == 'timeout'),
+            'spans': self.spans
+        }
+
+
+def default_scraped_data():
+    return {
         'bio': "Scraping failed: Could not find a bio.",
         'posts': ["(Scraping Failed - Could not extract post text)"] * 5
     }
-    
-    print(f"--- Starting Advanced Scrape for {profile_url} ---")
 
-    async with async_playwright() as p:
+
+async def _scrape_page(page, profile_url: str, scraped_data: dict, trace: ScrapeTrace, known_newest_post: str = None):
+    """
+    Runs the scrape on an already opened page and fills in scraped_data. Returns the
+    real post texts found. If known_newest_post is given, only posts above it in the
+    feed are collected and scrolling stops once it is reached.
+    """
+    print("Navigating to profile page...")
+    with trace.span('goto'):
+        await page.goto(profile_url, wait_until="domcontentloaded", timeout=45000)
+
+    # --- Wait for the main feed to be present ---
+    print("Waiting for the main feed container to appear...")
+    feed_selector = FEED_SELECTOR
+    with trace.span('feed_wait'):
+        await page.wait_for_selector(feed_selector, timeout=20000)
+    print("Feed container found. Waiting for the first post to render...")
+    try:
+        with trace.span('first_post_wait'):
+            await page.wait_for_selector(f'{feed_selector} > div', timeout=5000)
+    except PlaywrightTimeoutError:
+        print("No posts rendered in the feed yet.")
+
+    # --- Scroll until enough posts are loaded ---
+    print("Attempting to scrape posts...")
+    try:
+        await _scroll_until_enough_posts(page, feed_selector, trace, known_newest_post)
+    except Exception as e:
+        print(f"Scrolling stopped early: {e}")
+
+    # --- Extract bio and posts in one round trip ---
+    try:
+        with trace.span('extract'):
+            extracted = await page.evaluate(EXTRACT_TEXT_JS, [feed_selector, BIO_SELECTOR])
+    except Exception as e:
+        print(f"Could not extract page text: {e}")
+        return []
+
+    bio_text = (extracted.get('bio') or '').strip()
+    if bio_text:
+        scraped_data['bio'] = bio_text
+        _count('bio_found')
+        print(f"Successfully scraped bio: '{bio_text[:100]}...'")
+    else:
+        _count('bio_missing')
+        print("Could not scrape bio with primary selector.")
+
+    candidates = [text.strip() for text in (extracted.get('posts') or []) if text]
+    print(f"Found {len(candidates)} potential post elements after scrolling.")
+    if known_newest_post and known_newest_post in candidates:
+        # Everything from the previously newest post down is already cached
+        candidates = candidates[:candidates.index(known_newest_post)]
+    # Basic filtering to ensure it's a real post
+    post_texts = [text for text in candidates if len(text) > MIN_POST_LENGTH][:TARGET_POSTS]
+    for i, post_text in enumerate(post_texts):
+        print(f"  - Scraped Post {i + 1}: '{post_text[:70]}...'")
+
+    _count('posts_extracted', len(post_texts))
+    if post_texts:
+        scraped_data['posts'] = pad_posts(post_texts)
+        print("Successfully scraped recent posts.")
+    else:
+        print("Could not scrape posts: No valid post text could be extracted.")
+    return post_texts
+
+
+def pad_posts(posts):
+    posts = list(posts[:TARGET_POSTS])
+    while len(posts) < TARGET_POSTS:
+        posts.append("(No more public posts found)")
+    return posts
+
+
+async def _scroll_until_enough_posts(page, feed_selector, trace, known_newest_post=None):
+    """
+    Scrolls the feed until TARGET_POSTS qualifying posts are loaded, known_newest_post
+    is reached, the feed stops growing, or COLLECT_BUDGET_MS runs out. Each scroll
+    waits for new feed children to appear rather than sleeping for a fixed time.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + COLLECT_BUDGET_MS / 1000
+
+    for i in range(MAX_SCROLLS):
+        counts = await page.evaluate(COUNT_POSTS_JS, [feed_selector, MIN_POST_LENGTH, known_newest_post])
+        qualifying = counts['qualifying']
+        if qualifying >= TARGET_POSTS:
+            print(f"Found {qualifying} qualifying posts, no more scrolling needed.")
+            return
+        if counts['reachedKnown']:
+            print("Reached the newest previously scraped post, no more scrolling needed.")
+            return
+
+        remaining_ms = (deadline - loop.time()) * 1000
+        if remaining_ms <= 0:
+            print("Post collection budget exhausted.")
+            return
+
+        print(f"Scrolling down (Pass {i+1}/{MAX_SCROLLS}, {qualifying} qualifying posts so far)...")
         try:
-            browser = await p.chromium.launch(headless=True, args=["--no-sandbox"])
-            context = await browser.new_context(
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
-                java_script_enabled=True,
-                accept_downloads=False,
-                has_touch=False,
-                is_mobile=False,
-                locale='en-US'
+            with trace.span(f'scroll_{i + 1}', phase='scroll'):
+                await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
+                await page.wait_for_function(
+                    FEED_GREW_JS,
+                    arg=[feed_selector, counts['children']],
+                    timeout=max(1, min(SCROLL_WAIT_MS, remaining_ms))
+                )
+        except PlaywrightTimeoutError:
+            print("Feed stopped growing.")
+            return
+
+
+async def _block_heavy_resources(route):
+    request = route.request
+    host = urlparse(request.url).hostname or ''
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or host.endswith(BLOCKED_HOST_SUFFIXES):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+class ScraperService:
+    """
+    Keeps one warm Chromium browser and hands out isolated browser contexts from a
+    bounded pool, so many profiles can be scraped concurrently without a browser
+    launch per profile.
+
+        async with ScraperService(max_contexts=4) as service:
+            results = await service.scrape_many(urls)
+
+    The browser is launched by the first scrape that misses the cache, so a service
+    that only serves cached profiles never starts one.
+
+    With lean=True (the default) images, media, fonts and analytics scripts are
+    blocked, and the viewport and disk cache are kept small. Results are cached per
+    profile URL in scrape_cache for SCRAPE_CACHE_TTL seconds.
+    """
+
+    def __init__(self, max_contexts: int = 4, per_host_limit: int = 2, lean: bool = True):
+        self.max_contexts = max_contexts
+        self.per_host_limit = per_host_limit
+        self.lean = lean
+        self._playwright = None
+        self._browser = None
+        self._context_slots = None
+        # asyncio primitives are created lazily so they bind to the loop that uses them
+        self._host_slots = defaultdict(lambda: asyncio.Semaphore(self.per_host_limit))
+        self._start_lock = None
+
+    async def start(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            print("Launching shared scraper browser...")
+            args = ["--no-sandbox"] + (LEAN_BROWSER_ARGS if self.lean else [])
+            self._browser = await self._playwright.chromium.launch(headless=True, args=args)
+            self._context_slots = asyncio.Semaphore(self.max_contexts)
+
+    async def stop(self):
+        if self._browser is not None:
+            await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def _new_context(self):
+        options = dict(
+            user_agent=USER_AGENT,
+            java_script_enabled=True,
+            accept_downloads=False,
+            has_touch=False,
+            is_mobile=False,
+            locale='en-US'
+        )
+        if self.lean:
+            options.update(
+                viewport=LEAN_VIEWPORT,
+                device_scale_factor=1,
+                reduced_motion='reduce',
+                service_workers='block'
             )
-            page = await context.new_page()
-            
-            print("Navigating to profile page...")
-            await page.goto(profile_url, wait_until="domcontentloaded", timeout=45000)
-            
-            # --- Wait for the main feed to be present ---
-            print("Waiting for the main feed container to appear...")
-            feed_selector = 'div[role="feed"]'
-            await page.wait_for_selector(feed_selector, timeout=20000)
-            print("Feed container found. Waiting for content to settle...")
-            await page.wait_for_timeout(3000) # Give time for posts to render
-
-            # --- Scrape Bio ---
-            print("Attempting to scrape bio...")
-            try:
-                # This selector looks for a common bio pattern near the top of the profile
-                bio_element = page.locator('div[data-pagelet="ProfileTimeline"] div.x1b0d499.x1d69dk1').first
-                bio_text = await bio_element.inner_text(timeout=5000)
-                if bio_text:
-                    scraped_data['bio'] = bio_text
-                    print(f"Successfully scraped bio: '{bio_text[:100]}...'")
-            except Exception as e:
-                print(f"Could not scrape bio with primary selector: {e}")
+        context = await self._browser.new_context(**options)
+        if self.lean:
+            await context.route('**/*', _block_heavy_resources)
+        return context
 
-            # --- Scrape Posts with Scrolling ---
-            print("Attempting to scrape posts...")
-            post_texts = []
+    async def _scrape_live(self, profile_url: str, known_newest_post: str = None):
+        """
+        Scrapes one profile in a fresh, isolated context.
+        Returns (scraped_data, post_texts) where post_texts are the real posts found;
+        scraped_data['metrics'] holds the timing spans of this scrape.
+        """
+        scraped_data = default_scraped_data()
+        post_texts = []
+        trace = ScrapeTrace()
+        _count('scrapes_started')
+        print(f"--- Starting Advanced Scrape for {profile_url} ---")
+
+        try:
+            await self.start()
+            host = urlparse(profile_url).netloc.lower()
+            host_slot = self._host_slots[host]
+            context_slot = self._context_slots
+            with trace.span('pool_wait'):
+                await host_slot.acquire()
+                try:
+                    await context_slot.acquire()
+                except BaseException:
+                    host_slot.release()
+                    raise
             try:
-                # Scroll down a few times to load more posts
-                for i in range(3):
-                    print(f"Scrolling down (Pass {i+1}/3)...")
-                    await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
-                    await page.wait_for_timeout(2000) # Wait for new posts to load
-
-                # This selector targets the individual post containers within the feed
-                post_locators = page.locator(f'{feed_selector} > div')
-                count = await post_locators.count()
-                print(f"Found {count} potential post elements after scrolling.")
-
-                for i in range(min(10, count)): # Check up to 10 elements to find 5 posts
-                    if len(post_texts) >= 5:
-                        break
-                    
-                    post_element = post_locators.nth(i)
+                with trace.span('new_context'):
+                    context = await self._new_context()
+                try:
+                    page = await context.new_page()
                     try:
-                        # This looks for the specific div that holds the main text content
-                        text_div = post_element.locator('div[data-ad-preview="message"]').first
-                        post_text = await text_div.inner_text(timeout=2000)
-                        
-                        # Basic filtering to ensure it's a real post
-                        if post_text and len(post_text) > 20:
-                            post_texts.append(post_text.strip())
-                            print(f"  - Scraped Post {len(post_texts)}: '{post_text[:70]}...'")
-
-                    except Exception:
-                        # This element was likely not a post, so we skip it
-                        continue
-                
-                if post_texts:
-                    scraped_data['posts'] = post_texts
-                    while len(scraped_data['posts']) < 5:
-                        scraped_data['posts'].append("(No more public posts found)")
-                    print("Successfully scraped recent posts.")
-                else:
-                    raise Exception("No valid post text could be extracted.")
-
-            except Exception as e:
-                print(f"Could not scrape posts: {e}")
-            
-            await browser.close()
+                        post_texts = await asyncio.wait_for(
+                            _scrape_page(page, profile_url, scraped_data, trace, known_newest_post),
+                            timeout=SCRAPE_BUDGET_MS / 1000
+                        )
+                    except asyncio.TimeoutError:
+                        # Whatever was collected before the budget ran out is kept
+                        _count('scrapes_over_budget')
+                        print(f"Scrape budget of {SCRAPE_BUDGET_MS}ms exceeded for {profile_url}")
+                finally:
+                    await context.close()
+            finally:
+                context_slot.release()
+                host_slot.release()
             print("--- Scrape Complete ---")
-            
         except Exception as e:
+            _count('scrapes_errored')
             print(f"A critical error occurred during the scraping process: {e}")
             # The function will return the default error messages in scraped_data
 
-    return scraped_data
+        _count('scrapes_succeeded' if post_texts else 'scrapes_without_posts')
+        scraped_data['metrics'] = trace.summary()
+        return scraped_data, post_texts
+
+    async def _refresh(self, profile_url: str, entry: dict):
+        """
+        Incrementally refreshes a stale cache entry: only posts newer than the newest
+        cached one are scraped, then merged in front of the cached posts.
+        """
+        try:
+            known_newest = entry['posts'][0] if entry['posts'] else None
+            scraped_data, new_posts = await self._scrape_live(profile_url, known_newest)
+            bio_found = scraped_data['bio'] != default_scraped_data()['bio']
+            if not bio_found and not new_posts:
+                print(f"Refresh of {profile_url} found nothing, keeping the cached copy")
+                return
+            posts = new_posts + [post for post in entry['posts'] if post not in new_posts]
+            scrape_cache.put(
+                profile_url,
+                scraped_data['bio'] if bio_found else entry['bio'],
+                posts[:TARGET_POSTS]
+            )
+        except Exception as e:
+            print(f"Background refresh of {profile_url} failed: {e}")
+
+    async def scrape(self, profile_url: str, use_cache: bool = True):
+        """
+        Returns scraped data for one profile. Fresh cache entries are returned without
+        touching the browser; stale ones are returned immediately and refreshed on the
+        shared background refresher, so the caller never waits for the refresh. The 'cache' key reports which of 'fresh', 'stale' or 'miss' applied.
+        """
+        if use_cache:
+            try:
+                entry, is_fresh = scrape_cache.get(profile_url)
+            except Exception as e:
+                print(f"Scrape cache read error: {e}")
+                entry, is_fresh = None, False
+            if entry is not None:
+                _count('cache_fresh' if is_fresh else 'cache_stale')
+                if not is_fresh:
+                    _refresher.submit(profile_url, entry)
+                return {
+                    'bio': entry['bio'] or default_scraped_data()['bio'],
+                    'posts': pad_posts(entry['posts']),
+                    'cache': 'fresh' if is_fresh else 'stale',
+                    'metrics': {'total_ms': 0.0, 'timeouts': 0, 'spans': []}
+                }
+
+        scraped_data, post_texts = await self._scrape_live(profile_url)
+        bio_found = scraped_data['bio'] != default_scraped_data()['bio']
+        if use_cache and (bio_found or post_texts):
+            try:
+                scrape_cache.put(profile_url, scraped_data['bio'] if bio_found else None, post_texts)
+            except Exception as e:
+                print(f"Scrape cache write error: {e}")
+        _count('cache_miss')
+        scraped_data['cache'] = 'miss'
+        return scraped_data
+
+    async def scrape_batches(self, profile_urls, batch_size: int = 10):
+        """
+        Scrapes profile_urls concurrently and yields {url: scraped_data} dicts of up to
+        batch_size results as they complete.
+        """
+        async def scrape_one(url):
+            return url, await self.scrape(url)
+
+        tasks = [asyncio.ensure_future(scrape_one(url)) for url in profile_urls]
+        batch = {}
+        try:
+            for finished in asyncio.as_completed(tasks):
+                url, data = await finished
+                batch[url] = data
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = {}
+            if batch:
+                yield batch
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def scrape_many(self, profile_urls):
+        """
+        Scrapes all profile_urls concurrently and returns {url: scraped_data}.
+        """
+        results = {}
+        async for batch in self.scrape_batches(profile_urls):
+            results.update(batch)
+        return results
+
+
+class BackgroundRefresher:
+    """
+    Refreshes stale cache entries on a long-lived ScraperService running its own event
+    loop in a daemon thread. Callers hand the refresh off and return at once; it is not
+    tied to (or cancelled with) the caller's service or event loop, and the warm browser
+    is reused across refreshes.
+    """
+
+    def __init__(self, max_contexts: int = REFRESH_CONTEXTS):
+        self.max_contexts = max_contexts
+        self._loop = None
+        self._service = None
+        self._lock = threading.Lock()
+        # Normalized profile URLs with a refresh queued or running
+        self._pending = set()
+
+    def _ensure_started(self):
+        if self._loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='scrape-refresh', daemon=True).start()
+            self._service = ScraperService(max_contexts=self.max_contexts)
+            self._loop = loop
+
+    def submit(self, profile_url: str, entry: dict):
+        key = scrape_cache.normalize_profile_url(profile_url)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(self._service._refresh(profile_url, entry), self._loop)
+        future.add_done_callback(lambda _: self._done(key))
+
+    def _done(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+
+_refresher = BackgroundRefresher()
+
+
+async def scrape_public_profile(profile_url: str, lean: bool = True, use_cache: bool = True):
+    """
+    Scrapes a public Facebook profile, launching a browser only if the profile is not
+    cached. For more than one profile, use a long-lived ScraperService instead.
+    """
+    async with ScraperService(max_contexts=1, lean=lean) as service:
+        return await service.scrape(profile_url, use_cache=use_cache)
+
+
+async def scrape_public_profiles(profile_urls, max_contexts: int = 4, per_host_limit: int = 2, lean: bool = True):
+    """
+    Scrapes many public profiles with a single warm browser.
+    """
+    async with ScraperService(max_contexts=max_contexts, per_host_limit=per_host_limit, lean=lean) as service:
+        return await service.scrape_many(profile_urls)
@@ -0,0 +1,539 @@
+# datastore.py
+# Persistent storage for brand profiles, social posts, leads, team members and generations.
+#
+# The backend is chosen from DATABASE_URL (default: sqlite:///auramarkt.db). New backends
+# register a class in BACKENDS that implements the same methods as SQLiteStore.
+
+import base64
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import local_db
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///auramarkt.db')
+POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 8))
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS brand_profiles (
+        user TEXT PRIMARY KEY,
+        slogan TEXT,
+        tone TEXT,
+        updated_at REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS social_posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        content TEXT NOT NULL,
+        scheduled_date TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'scheduled',
+        created_at REAL NOT NULL,
+        due_at REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_at REAL,
+        external_id TEXT,
+        last_error TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_social_posts_user_date ON social_posts(user, scheduled_date, id)',
+    '''CREATE TABLE IF NOT EXISTS leads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        name TEXT NOT NULL,
+        contact TEXT NOT NULL,
+        type TEXT,
+        created_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_leads_user_created ON leads(user, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_leads_user_type ON leads(user, type, id)',
+    '''CREATE TABLE IF NOT EXISTS team_members (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        name TEXT NOT NULL,
+        email TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        UNIQUE (user, email)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS generations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        persona TEXT NOT NULL,
+        fallback INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_generations_user_persona ON generations(user, persona)',
+]
+
+# Columns added after a table was first created: (table, column, definition)
+MIGRATIONS = [
+    ('social_posts', 'due_at', 'REAL'),
+    ('social_posts', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+    ('social_posts', 'claimed_at', 'REAL'),
+    ('social_posts', 'external_id', 'TEXT'),
+    ('social_posts', 'last_error', 'TEXT'),
+]
+
+# Created after MIGRATIONS so they can use the added columns
+POST_MIGRATION_SCHEMA = [
+    'CREATE INDEX IF NOT EXISTS idx_social_posts_status_due ON social_posts(status, due_at)',
+    # Covers the type-filtered lead listing in its own sort order
+    'DROP INDEX IF EXISTS idx_leads_user_type',
+    'CREATE INDEX IF NOT EXISTS idx_leads_user_type_created ON leads(user, type, created_at, id)',
+]
+
+# Full-text index over lead name and contact, kept in step with the leads table by triggers.
+# prefix='2 3' pre-builds the short prefixes typed into the search box.
+LEAD_SEARCH_SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+        name, contact, content='leads', content_rowid='id', prefix='2 3'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS leads_fts_insert AFTER INSERT ON leads BEGIN
+        INSERT INTO leads_fts (rowid, name, contact) VALUES (new.id, new.name, new.contact);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS leads_fts_delete AFTER DELETE ON leads BEGIN
+        INSERT INTO leads_fts (leads_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS leads_fts_update AFTER UPDATE ON leads BEGIN
+        INSERT INTO leads_fts (leads_fts, rowid, name, contact) VALUES ('delete', old.id, old.name, old.contact);
+        INSERT INTO leads_fts (rowid, name, contact) VALUES (new.id, new.name, new.contact);
+    END''',
+]
+
+# Dashboard aggregates, updated in the same transaction as the events they count so the
+# insights endpoint reads a handful of rows instead of scanning history.
+AGGREGATE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS user_stats (
+        user TEXT PRIMARY KEY,
+        generations INTEGER NOT NULL DEFAULT 0,
+        fallbacks INTEGER NOT NULL DEFAULT 0,
+        posts INTEGER NOT NULL DEFAULT 0,
+        published_posts INTEGER NOT NULL DEFAULT 0,
+        leads INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS persona_stats (
+        user TEXT NOT NULL,
+        persona TEXT NOT NULL,
+        generations INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user, persona)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_persona_stats_rank ON persona_stats(user, generations DESC, persona)',
+    # One row per user, UTC day and metric; rolling windows sum at most WINDOW_DAYS rows per metric
+    '''CREATE TABLE IF NOT EXISTS daily_stats (
+        user TEXT NOT NULL,
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user, day, metric)
+    ) WITHOUT ROWID''',
+]
+
+STAT_COLUMNS = ('generations', 'fallbacks', 'posts', 'published_posts', 'leads')
+DAILY_METRICS = ('generations', 'posts', 'leads')
+WINDOW_DAYS = 7
+TOP_PERSONAS = 3
+
+# Posts scheduled with a bare date go out at this hour (UTC)
+DEFAULT_POST_HOUR = int(os.getenv('SOCIAL_POST_DEFAULT_HOUR', 9))
+
+
+def parse_due_at(value, default_hour=DEFAULT_POST_HOUR):
+    """
+    Turns a 'YYYY-MM-DD' or ISO 8601 datetime into a UTC timestamp.
+    Raises ValueError for anything else.
+    """
+    value = value.strip()
+    if len(value) == 10:
+        parsed = datetime.strptime(value, '%Y-%m-%d').replace(hour=default_hour)
+    else:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def clamp_page(limit, offset):
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except (TypeError, ValueError):
+        limit = DEFAULT_PAGE_SIZE
+    try:
+        offset = int(offset) if offset is not None else 0
+    except (TypeError, ValueError):
+        offset = 0
+    return max(1, min(limit, MAX_PAGE_SIZE)), max(0, offset)
+
+
+def utc_day(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+
+def bump_stats(conn, user, at=None, **deltas):
+    """
+    Adds deltas (keyword per STAT_COLUMNS) to the user's totals and, for DAILY_METRICS,
+    to today's bucket. Call inside the transaction that records the event.
+    """
+    columns = [column for column in deltas if column in STAT_COLUMNS]
+    conn.execute(
+        f'''INSERT INTO user_stats (user, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})
+            ON CONFLICT(user) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in columns)}''',
+        [user] + [deltas[column] for column in columns]
+    )
+    day = utc_day(at if at is not None else time.time())
+    for metric in DAILY_METRICS:
+        if deltas.get(metric):
+            conn.execute(
+                '''INSERT INTO daily_stats (user, day, metric, count) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user, day, metric) DO UPDATE SET count = count + excluded.count''',
+                (user, day, metric, deltas[metric])
+            )
+
+
+def encode_cursor(created_at, row_id):
+    return base64.urlsafe_b64encode(f"{created_at!r}:{row_id}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (created_at, id) position an opaque page cursor points at. Raises ValueError.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split(':')
+        return float(created_at), int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
+def search_query(text):
+    """
+    Turns free text into an FTS5 query where every word must match as a prefix.
+    """
+    words = re.findall(r'\w+', text)
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of SQLite connections shared by all request threads.
+    """
+
+    def __init__(self, path, size):
+        self._connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            # Statements are always parameterised, so sqlite3's statement cache
+            # acts as a prepared-statement cache per connection.
+            conn = local_db.open_connection(path, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._connections.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn, local_db.immediate(conn):
+            yield conn
+
+
+class SQLiteStore:
+
+    def __init__(self, path, pool_size=POOL_SIZE):
+        self.pool = ConnectionPool(path, pool_size)
+        with self.pool.transaction() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+            for table, column, definition in MIGRATIONS:
+                columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            for statement in POST_MIGRATION_SCHEMA:
+                conn.execute(statement)
+            self.lead_search = self._create_lead_search(conn)
+            self._create_aggregates(conn)
+
+    def _create_lead_search(self, conn):
+        # Builds the search index on first run; SQLite builds without FTS5 fall back to LIKE
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads_fts'"
+        ).fetchone()
+        try:
+            for statement in LEAD_SEARCH_SCHEMA:
+                conn.execute(statement)
+        except sqlite3.OperationalError as e:
+            print(f"Lead search index unavailable, using LIKE: {e}")
+            return False
+        if not exists:
+            conn.execute("INSERT INTO leads_fts (leads_fts) VALUES ('rebuild')")
+        return True
+
+    def _create_aggregates(self, conn):
+        # Existing databases get their aggregates computed once from the raw tables
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'"
+        ).fetchone()
+        for statement in AGGREGATE_SCHEMA:
+            conn.execute(statement)
+        if not exists:
+            self.rebuild_aggregates(conn)
+
+    def rebuild_aggregates(self, conn):
+        """
+        Recomputes every aggregate from the event tables. Only needed after a migration or
+        a manual edit of the raw data.
+        """
+        for table in ('user_stats', 'persona_stats', 'daily_stats'):
+            conn.execute(f'DELETE FROM {table}')
+        conn.execute('''INSERT INTO user_stats (user, generations, fallbacks)
+                        SELECT user, COUNT(*), SUM(fallback) FROM generations GROUP BY user''')
+        conn.execute('''INSERT INTO user_stats (user, posts, published_posts)
+                        SELECT user, COUNT(*), SUM(status = 'published') FROM social_posts GROUP BY user
+                        ON CONFLICT(user) DO UPDATE SET posts = excluded.posts,
+                            published_posts = excluded.published_posts''')
+        conn.execute('''INSERT INTO user_stats (user, leads)
+                        SELECT user, COUNT(*) FROM leads GROUP BY user
+                        ON CONFLICT(user) DO UPDATE SET leads = excluded.leads''')
+        conn.execute('''INSERT INTO persona_stats (user, persona, generations)
+                        SELECT user, persona, COUNT(*) FROM generations GROUP BY user, persona''')
+        for metric, table in (('generations', 'generations'), ('posts', 'social_posts'), ('leads', 'leads')):
+            conn.execute(f'''INSERT INTO daily_stats (user, day, metric, count)
+                             SELECT user, strftime('%Y-%m-%d', created_at, 'unixepoch'), ?, COUNT(*)
+                             FROM {table} GROUP BY 1, 2''', (metric,))
+
+    # --- Brand profiles ---
+
+    def save_brand_profile(self, user, slogan, tone):
+        with self.pool.connection() as conn:
+            conn.execute(
+                '''INSERT INTO brand_profiles (user, slogan, tone, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user) DO UPDATE SET slogan = excluded.slogan, tone = excluded.tone,
+                   updated_at = excluded.updated_at''',
+                (user, slogan, tone, time.time())
+            )
+
+    def get_brand_profile(self, user):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT slogan, tone FROM brand_profiles WHERE user = ?', (user,)).fetchone()
+        return dict(row) if row else None
+
+    # --- Social posts ---
+
+    def add_social_post(self, user, content, scheduled_date, due_at):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO social_posts (user, content, scheduled_date, due_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                (user, content, scheduled_date, due_at, now)
+            )
+            bump_stats(conn, user, at=now, posts=1)
+        return cursor.lastrowid
+
+    def list_social_posts(self, user, limit=None, offset=None):
+        limit, offset = clamp_page(limit, offset)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                '''SELECT id, content, scheduled_date AS date, status FROM social_posts
+                   WHERE user = ? ORDER BY scheduled_date, id LIMIT ? OFFSET ?''',
+                (user, limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    # The dispatcher only ever reads the head of the (status, due_at) index
+
+    def next_due_social_posts(self, until, limit):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                '''SELECT id, due_at FROM social_posts
+                   WHERE status = 'scheduled' AND due_at <= ? ORDER BY due_at LIMIT ?''',
+                (until, limit)
+            ).fetchall()
+        return [(row['due_at'], row['id']) for row in rows]
+
+    def claim_social_post(self, post_id, now):
+        """
+        Atomically moves a due post to 'dispatching'. Returns the post if this caller won it.
+        """
+        with self.pool.transaction() as conn:
+            claimed = conn.execute(
+                '''UPDATE social_posts SET status = 'dispatching', claimed_at = ?, attempts = attempts + 1
+                   WHERE id = ? AND status = 'scheduled' AND due_at <= ?''',
+                (now, post_id, now)
+            ).rowcount
+            if not claimed:
+                return None
+            row = conn.execute(
+                'SELECT id, user, content, scheduled_date, attempts FROM social_posts WHERE id = ?', (post_id,)
+            ).fetchone()
+        return dict(row)
+
+    def release_stale_claims(self, claimed_before):
+        # Posts left 'dispatching' by a crashed worker go back to the queue
+        with self.pool.connection() as conn:
+            return conn.execute(
+                '''UPDATE social_posts SET status = 'scheduled'
+                   WHERE status = 'dispatching' AND claimed_at < ?''',
+                (claimed_before,)
+            ).rowcount
+
+    def finish_social_post(self, post_id, status, external_id=None, error=None, retry_at=None):
+        with self.pool.transaction() as conn:
+            row = conn.execute('SELECT user, status FROM social_posts WHERE id = ?', (post_id,)).fetchone()
+            if row is None:
+                return
+            conn.execute(
+                '''UPDATE social_posts SET status = ?, external_id = COALESCE(?, external_id),
+                   last_error = ?, due_at = COALESCE(?, due_at) WHERE id = ?''',
+                (status, external_id, error, retry_at, post_id)
+            )
+            if status == 'published' and row['status'] != 'published':
+                bump_stats(conn, row['user'], published_posts=1)
+
+    # --- Leads ---
+
+    def add_lead(self, user, name, contact, lead_type):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO leads (user, name, contact, type, created_at) VALUES (?, ?, ?, ?, ?)',
+                (user, name, contact, lead_type, now)
+            )
+            bump_stats(conn, user, at=now, leads=1)
+        return cursor.lastrowid
+
+    def list_leads(self, user, limit=None, cursor=None, lead_type=None, since=None, until=None, search=None):
+        """
+        Returns (leads, next_cursor), newest first. Pages continue from the (created_at, id)
+        position in cursor rather than an OFFSET, so every page costs one index seek.
+        since is inclusive and until exclusive; search matches name/contact word prefixes.
+        """
+        limit, _ = clamp_page(limit, 0)
+        clauses, params = ['user = ?'], [user]
+        if lead_type:
+            clauses.append('type = ?')
+            params.append(lead_type)
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(until)
+        if search:
+            if self.lead_search:
+                query = search_query(search)
+                if query:
+                    clauses.append('id IN (SELECT rowid FROM leads_fts WHERE leads_fts MATCH ?)')
+                    params.append(query)
+            else:
+                pattern = search.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                clauses.append("(name LIKE ? ESCAPE '\\' OR contact LIKE ? ESCAPE '\\')")
+                params.extend([pattern, pattern])
+        if cursor:
+            created_at, row_id = decode_cursor(cursor)
+            clauses.append('(created_at, id) < (?, ?)')
+            params.extend([created_at, row_id])
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f'''SELECT id, name, contact, type, created_at FROM leads
+                    WHERE {' AND '.join(clauses)} ORDER BY created_at DESC, id DESC LIMIT ?''',
+                params + [limit + 1]
+            ).fetchall()
+        leads = [dict(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(leads[-1]['created_at'], leads[-1]['id']) if len(rows) > limit else None
+        return leads, next_cursor
+
+    # --- Team members ---
+
+    def add_team_member(self, user, name, email):
+        with self.pool.connection() as conn:
+            cursor = conn.execute(
+                '''INSERT INTO team_members (user, name, email, created_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(user, email) DO UPDATE SET name = excluded.name''',
+                (user, name, email.lower(), time.time())
+            )
+        return cursor.lastrowid
+
+    def list_team_members(self, user, limit=None, offset=None):
+        limit, offset = clamp_page(limit, offset)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                'SELECT id, name, email FROM team_members WHERE user = ? ORDER BY id LIMIT ? OFFSET ?',
+                (user, limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    # --- Generations and insights ---
+
+    def record_generation(self, user, persona, fallback=False):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            conn.execute(
+                'INSERT INTO generations (user, persona, fallback, created_at) VALUES (?, ?, ?, ?)',
+                (user, persona, int(fallback), now)
+            )
+            bump_stats(conn, user, at=now, generations=1, fallbacks=int(fallback))
+            conn.execute(
+                '''INSERT INTO persona_stats (user, persona, generations) VALUES (?, ?, 1)
+                   ON CONFLICT(user, persona) DO UPDATE SET generations = generations + 1''',
+                (user, persona)
+            )
+
+    def get_performance_summary(self, user):
+        # Reads only precomputed rows: one totals row, the top of the persona ranking
+        # and at most WINDOW_DAYS daily buckets per metric
+        window_start = utc_day(time.time() - (WINDOW_DAYS - 1) * 86400)
+        with self.pool.connection() as conn:
+            totals = conn.execute('SELECT * FROM user_stats WHERE user = ?', (user,)).fetchone()
+            personas = conn.execute(
+                '''SELECT persona, generations FROM persona_stats WHERE user = ?
+                   ORDER BY generations DESC, persona LIMIT ?''',
+                (user, TOP_PERSONAS)
+            ).fetchall()
+            recent = dict(conn.execute(
+                '''SELECT metric, SUM(count) FROM daily_stats
+                   WHERE user = ? AND day >= ? GROUP BY metric''',
+                (user, window_start)
+            ).fetchall())
+        totals = dict(totals) if totals else dict.fromkeys(STAT_COLUMNS, 0)
+        fallback_rate = 100.0 * totals['fallbacks'] / totals['generations'] if totals['generations'] else 0.0
+        return {
+            'totalListings': totals['generations'],
+            'fallbackRate': f"{fallback_rate:.1f}%",
+            'topPersona': personas[0]['persona'] if personas else None,
+            'topPersonas': [{'persona': row['persona'], 'count': row['generations']} for row in personas],
+            'totalPosts': totals['posts'],
+            'publishedPosts': totals['published_posts'],
+            'totalLeads': totals['leads'],
+            'recent': {metric: recent.get(metric, 0) for metric in DAILY_METRICS},
+            'recentDays': WINDOW_DAYS
+        }
+
+BACKENDS = {
+    'sqlite': lambda url: SQLiteStore(url[len('sqlite:///'):])
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                scheme = DATABASE_URL.split(':', 1)[0]
+                if scheme not in BACKENDS:
+                    raise ValueError(f"Unsupported DATABASE_URL scheme: {scheme}")
+                _store = BACKENDS[scheme](DATABASE_URL)
+    return _store
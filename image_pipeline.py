@@ -0,0 +1,98 @@
+# image_pipeline.py
+# Decodes uploads once and produces compact JPEG derivatives for the vision API and previews.
+
+import base64
+import mimetypes
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+# OpenAI's "low" detail mode looks at a 512x512 version of the image, so anything
+# larger is only wasted upload bytes and JSON serialization time.
+VISION_MAX_SIDE = 512
+VISION_JPEG_QUALITY = 85
+VISION_SUFFIX = '.vision.jpg'
+
+# Preview widths the gallery may ask for via /uploads/<name>?w=
+THUMBNAIL_WIDTHS = (160, 320, 640, 1280)
+THUMBNAIL_JPEG_QUALITY = 80
+
+
+def vision_path(image_path):
+    return image_path + VISION_SUFFIX
+
+
+def guess_mime_type(image_path):
+    mime, _ = mimetypes.guess_type(image_path)
+    return mime or 'application/octet-stream'
+
+
+def downscale_to_jpeg(src_path, dest_path, max_width, max_height, quality=VISION_JPEG_QUALITY):
+    """
+    Decodes src_path, fits it inside max_width x max_height and writes a JPEG to dest_path atomically.
+    """
+    with Image.open(src_path) as img:
+        # Let the JPEG decoder skip straight to a reduced scale when it can
+        img.draft('RGB', (max_width, max_height))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail((max_width, max_height), Image.LANCZOS)
+
+        tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+def prepare_for_vision(image_path):
+    """
+    Returns (path, mime_type) of the image to send upstream, creating the downscaled
+    copy next to the original on first use. Falls back to the original file if it
+    cannot be decoded.
+    """
+    out_path = vision_path(image_path)
+    if os.path.exists(out_path):
+        return out_path, 'image/jpeg'
+    try:
+        downscale_to_jpeg(image_path, out_path, VISION_MAX_SIDE, VISION_MAX_SIDE)
+        return out_path, 'image/jpeg'
+    except Exception as e:
+        print(f"Image preprocessing error for {image_path}: {e}")
+        return image_path, guess_mime_type(image_path)
+
+
+def thumbnail_path(image_path, width):
+    return f"{image_path}.w{width}.jpg"
+
+
+def ensure_thumbnail(image_path, width):
+    """
+    Returns the path of a JPEG preview at most width pixels wide, creating and caching it
+    next to the original on first request.
+    """
+    out_path = thumbnail_path(image_path, width)
+    if not os.path.exists(out_path):
+        # Width is the constraint; the height bound only guards against absurd panoramas
+        downscale_to_jpeg(image_path, out_path, width, width * 4, quality=THUMBNAIL_JPEG_QUALITY)
+    return out_path
+
+
+def encode_for_vision(image_path):
+    """
+    Returns a data URL for the preprocessed image, or None if it cannot be read.
+    """
+    try:
+        path, mime = prepare_for_vision(image_path)
+        with open(path, 'rb') as image_file:
+            encoded = base64.b64encode(image_file.read()).decode('utf-8')
+        return f"data:{mime};base64,{encoded}"
+    except Exception as e:
+        print(f"Base64 encoding error: {e}")
+        return None
@@ -0,0 +1,175 @@
+# jobs.py
+# Background job runner for long AI generations.
+#
+# Work runs on a bounded thread pool inside each web process, while job state lives
+# in SQLite so a status poll can be answered by any gunicorn worker.
+#
+# The process that owns a job refreshes its heartbeat_at every JOB_HEARTBEAT_INTERVAL
+# seconds. A pending or running job whose heartbeat is older than JOB_LEASE belonged to
+# a worker that died or was restarted, and is marked failed the next time it is read.
+
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import local_db
+
+JOBS_PATH = os.getenv('JOBS_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.getenv('GENERATION_WORKERS', 8))
+JOB_MAX_PENDING = int(os.getenv('GENERATION_MAX_PENDING', 64))
+JOB_RETENTION = int(os.getenv('GENERATION_JOB_RETENTION', 24 * 3600))
+JOB_HEARTBEAT_INTERVAL = 15
+JOB_LEASE = int(os.getenv('GENERATION_JOB_LEASE', 60))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='generation')
+_lock = threading.Lock()
+_pending = 0
+# Ids of the jobs queued or running in this process, kept alive by the heartbeat thread
+_owned = set()
+_heartbeat_thread = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _migrate(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+    if 'heartbeat_at' not in columns:
+        conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs(updated_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_heartbeat ON jobs(status, heartbeat_at)')
+
+
+# Writes use sqlite3's implicit transactions and commit() explicitly
+_db = local_db.LocalDB(JOBS_PATH, [
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        heartbeat_at REAL
+    )''',
+], setup=_migrate, isolation_level='')
+
+
+def _set_status(job_id, status, result=None, error=None):
+    now = time.time()
+    conn = _db.connect()
+    conn.execute(
+        'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, heartbeat_at = ? WHERE id = ?',
+        (status, json.dumps(result) if result is not None else None, error, now, now, job_id)
+    )
+    conn.commit()
+
+
+def _heartbeat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_INTERVAL)
+        with _lock:
+            owned = list(_owned)
+        if not owned:
+            continue
+        try:
+            conn = _db.connect()
+            conn.executemany('UPDATE jobs SET heartbeat_at = ? WHERE id = ?', [(time.time(), job_id) for job_id in owned])
+            conn.commit()
+        except Exception as e:
+            print(f"Job heartbeat error: {e}")
+
+
+def _fail_stale(conn, now, job_id=None):
+    # Jobs whose owner stopped heartbeating will never finish; report them as failed
+    query = '''UPDATE jobs SET status = ?, error = ?, updated_at = ?
+               WHERE status IN (?, ?) AND COALESCE(heartbeat_at, updated_at) < ?'''
+    params = [FAILED, 'Generation was interrupted, please retry', now, PENDING, RUNNING, now - JOB_LEASE]
+    if job_id is not None:
+        query += ' AND id = ?'
+        params.append(job_id)
+    conn.execute(query, params)
+    conn.commit()
+
+
+def _run(job_id, fn, args):
+    global _pending
+    try:
+        _set_status(job_id, RUNNING)
+        result = fn(*args)
+        _set_status(job_id, DONE, result=result)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        _set_status(job_id, FAILED, error=str(e))
+    finally:
+        with _lock:
+            _pending -= 1
+            _owned.discard(job_id)
+
+
+def submit(fn, *args):
+    """
+    Queues fn(*args) and returns the new job id immediately.
+    Raises QueueFull when this process already has too many jobs waiting.
+    """
+    global _pending, _heartbeat_thread
+    job_id = str(uuid.uuid4())
+    with _lock:
+        if _pending >= JOB_MAX_PENDING:
+            raise QueueFull()
+        _pending += 1
+        _owned.add(job_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat, name='generation-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+    now = time.time()
+    try:
+        conn = _db.connect()
+        conn.execute(
+            'INSERT INTO jobs (id, status, created_at, updated_at, heartbeat_at) VALUES (?, ?, ?, ?, ?)',
+            (job_id, PENDING, now, now, now)
+        )
+        conn.execute('DELETE FROM jobs WHERE updated_at < ?', (now - JOB_RETENTION,))
+        conn.commit()
+        _fail_stale(conn, now)
+        _executor.submit(_run, job_id, fn, args)
+    except Exception:
+        with _lock:
+            _pending -= 1
+            _owned.discard(job_id)
+        raise
+    return job_id
+
+
+def get(job_id):
+    conn = _db.connect()
+    query = 'SELECT status, result, error, created_at, updated_at, heartbeat_at FROM jobs WHERE id = ?'
+    row = conn.execute(query, (job_id,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if row[0] in (PENDING, RUNNING) and (row[5] or row[4]) < now - JOB_LEASE:
+        _fail_stale(conn, now, job_id)
+        row = conn.execute(query, (job_id,)).fetchone()
+    status, result, error, created_at, updated_at, _ = row
+    return {
+        'job_id': job_id,
+        'status': status,
+        'result': json.loads(result) if result else None,
+        'error': error,
+        'created_at': created_at,
+        'updated_at': updated_at
+    }
+
+
+def is_finished(job):
+    return job['status'] in (DONE, FAILED)
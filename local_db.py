@@ -0,0 +1,64 @@
+# local_db.py
+# Shared SQLite plumbing for the small single-file databases: result and scrape caches,
+# jobs, trial ledger, upload index and upstream guard. Each thread gets its own
+# connection, opened in WAL mode with the module's schema applied on first use.
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+def open_connection(path, isolation_level=None, **kwargs):
+    """
+    Opens a WAL-mode connection. isolation_level=None (autocommit, with explicit
+    BEGIN IMMEDIATE for write transactions) unless the caller relies on sqlite3's
+    implicit transactions.
+    """
+    conn = sqlite3.connect(path, timeout=10, isolation_level=isolation_level, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+@contextmanager
+def immediate(conn):
+    """
+    Runs the block in a BEGIN IMMEDIATE transaction on an autocommit connection, so
+    the write lock is taken up front rather than on the first write.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+class LocalDB:
+    """
+    One connection per thread to the database at path. schema is a list of statements
+    run when a thread first connects, followed by setup(conn) for migrations.
+    """
+
+    def __init__(self, path, schema=(), setup=None, isolation_level=None):
+        self.path = path
+        self.schema = list(schema)
+        self.setup = setup
+        self.isolation_level = isolation_level
+        self._local = threading.local()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = open_connection(self.path, self.isolation_level)
+            for statement in self.schema:
+                conn.execute(statement)
+            if self.setup is not None:
+                self.setup(conn)
+            if conn.in_transaction:
+                conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def transaction(self):
+        return immediate(self.connect())
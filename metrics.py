@@ -0,0 +1,149 @@
+# metrics.py
+# Prometheus instrumentation: per-route latency and status, per-stage generation timings,
+# upstream/cache/fallback counters, scraper phase timings, upload sweeper totals and in-flight
+# gauges, served on /metrics.
+#
+# Each gunicorn worker keeps its own values. Point PROMETHEUS_MULTIPROC_DIR at an empty
+# directory (wiped on deploy) so /metrics sums every worker instead of reporting
+# whichever one answered the scrape, and call multiprocess.mark_process_dead(worker.pid)
+# from gunicorn's child_exit hook so in-flight gauges drop exited workers.
+
+import os
+import time
+
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+
+# Generation requests range from cached hits (milliseconds) to slow vision calls (a minute+)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90)
+
+REQUEST_LATENCY = Histogram(
+    'auramarkt_request_duration_seconds', 'Time to build the HTTP response, by route',
+    ['route', 'method'], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter('auramarkt_requests_total', 'HTTP responses by route and status', ['route', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge(
+    'auramarkt_requests_in_flight', 'Requests currently being handled', ['route'], multiprocess_mode='livesum'
+)
+STAGE_LATENCY = Histogram(
+    'auramarkt_stage_duration_seconds', 'Time spent in each upload/generation stage',
+    ['stage'], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_RESPONSES = Counter(
+    'auramarkt_upstream_responses_total', 'OpenAI attempts by HTTP status (or "error" for connection failures)',
+    ['status']
+)
+UPSTREAM_ERRORS = UPSTREAM_RESPONSES.labels('error')
+UPSTREAM_IN_FLIGHT = Gauge(
+    'auramarkt_upstream_requests_in_flight', 'OpenAI requests currently open', multiprocess_mode='livesum'
+)
+FALLBACKS = Counter('auramarkt_fallbacks_total', 'Kits served from fallback content instead of the model')
+CACHE_LOOKUPS = Counter('auramarkt_result_cache_lookups_total', 'Result cache lookups', ['result'])
+# Fixed label sets are bound once so hot paths skip the label lookup
+CACHE_HITS = CACHE_LOOKUPS.labels('hit')
+CACHE_MISSES = CACHE_LOOKUPS.labels('miss')
+# Profile scraper (bot.py). A scraper running outside the web workers shows up here when it
+# shares their PROMETHEUS_MULTIPROC_DIR.
+SCRAPE_PHASE_LATENCY = Histogram(
+    'auramarkt_scrape_phase_duration_seconds', 'Time spent in each profile scraper phase, by outcome',
+    ['phase', 'status'], buckets=LATENCY_BUCKETS
+)
+SCRAPER_EVENTS = Counter(
+    'auramarkt_scraper_events_total', 'Scraper outcomes: scrapes, cache hits, timeouts, posts extracted', ['event']
+)
+# Upload sweeper (upload_store.py). Also read back by /api/storage_stats, which needs the
+# totals across every worker rather than the one that answered.
+UPLOAD_SWEEPS = Counter('auramarkt_upload_sweeps_total', 'Upload sweeper runs')
+UPLOAD_SWEEP_FILES = Counter('auramarkt_upload_sweep_files_deleted_total', 'Files removed by the upload sweeper')
+UPLOAD_SWEEP_BYTES = Counter('auramarkt_upload_sweep_bytes_reclaimed_total', 'Bytes reclaimed by the upload sweeper')
+# Per worker, so the duration can be matched to the most recent start
+UPLOAD_SWEEP_STARTED = Gauge(
+    'auramarkt_upload_sweep_last_start_timestamp_seconds', 'Start of the last upload sweep', multiprocess_mode='all'
+)
+UPLOAD_SWEEP_DURATION = Gauge(
+    'auramarkt_upload_sweep_last_duration_seconds', 'Duration of the last upload sweep', multiprocess_mode='all'
+)
+
+
+class stage:
+    """
+    Times a block into STAGE_LATENCY:  with metrics.stage('image_encoding'): ...
+    """
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, name):
+        self.histogram = STAGE_LATENCY.labels(name)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+def observe_stage(name, seconds):
+    # For stages that do not fit a with block, such as one spanning a generator's yields
+    STAGE_LATENCY.labels(name).observe(seconds)
+
+
+def _route():
+    # The URL rule, not the path, so /uploads/<filename> is one series rather than one per file
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def init_app(app):
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = _route()
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+    @app.after_request
+    def _record_request(response):
+        # Streamed responses (SSE, NDJSON) are timed to their first byte, not to the end of the stream
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = g.metrics_route
+            REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - started)
+            REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+        return response
+
+    @app.teardown_request
+    def _end_request(exc):
+        route = g.pop('metrics_route', None)
+        if route is not None:
+            REQUESTS_IN_FLIGHT.labels(route).dec()
+
+
+def _registry():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def samples(metric):
+    """
+    Current samples of an unlabelled metric across every worker: one summed sample for
+    counters, one per worker (labelled pid) for multiprocess_mode='all' gauges.
+    """
+    family = metric._name
+    for collected in _registry().collect():
+        if collected.name == family:
+            return [sample for sample in collected.samples if sample.name in (family, family + '_total')]
+    return []
+
+
+def total(counter):
+    return sum(sample.value for sample in samples(counter))
+
+
+def render():
+    """
+    Returns (body, content_type) in the Prometheus text format.
+    """
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
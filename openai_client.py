@@ -0,0 +1,151 @@
+# openai_client.py
+# Shared keep-alive HTTP client for OpenAI calls, with retry and backoff.
+
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import upstream_guard
+
+# Overridable so load tests can point the app at a local mock
+CHAT_COMPLETIONS_URL = os.getenv('OPENAI_CHAT_COMPLETIONS_URL', "https://api.openai.com/v1/chat/completions")
+
+# Kept-alive connections per process; roughly the number of threads that call OpenAI at once
+POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', 16))
+DEADLINE = float(os.getenv('OPENAI_DEADLINE', 90))
+ATTEMPT_TIMEOUT = float(os.getenv('OPENAI_ATTEMPT_TIMEOUT', 60))
+MAX_ATTEMPTS = int(os.getenv('OPENAI_MAX_ATTEMPTS', 4))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the process-wide session. Connections are kept alive and reused across threads.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # POOL_SIZE connections are kept alive; callers beyond that open a one-off
+                # connection rather than waiting for a free one with no timeout, which would
+                # ignore DEADLINE. The rate limiter bounds how many calls are in flight.
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=False)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _backoff(attempt):
+    # Full jitter: a random wait between 0 and the capped exponential step
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def post_chat_completion(payload, api_key, deadline=None, stream=False):
+    """
+    POSTs payload to the chat completions endpoint, retrying 429/5xx responses and
+    connection errors until MAX_ATTEMPTS or the overall deadline (seconds) runs out.
+    Returns the last response, or raises the last connection error.
+
+    Raises upstream_guard.UpstreamUnavailable at once while the circuit breaker is open
+    or when no request slot frees up within LIMITER_MAX_WAIT.
+    """
+    probe = upstream_guard.breaker.allow()
+    try:
+        # Probes find out whether the upstream has recovered; they are not retried
+        return _post_with_retries(payload, api_key, deadline, stream, probe)
+    except upstream_guard.UpstreamUnavailable:
+        upstream_guard.breaker.release(probe)
+        raise
+
+
+def _post_with_retries(payload, api_key, deadline, stream, probe):
+    # Every attempt reports to the breaker, so an outage trips it after a few failed
+    # attempts across all workers rather than after whole calls time out
+    max_attempts = 1 if probe else MAX_ATTEMPTS
+    deadline_at = time.monotonic() + (deadline if deadline is not None else DEADLINE)
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    session = get_session()
+
+    attempt = 0
+    while True:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise requests.Timeout("OpenAI request deadline exceeded")
+        if not upstream_guard.requests_per_minute.acquire(1, max_wait=min(upstream_guard.LIMITER_MAX_WAIT, remaining)):
+            raise upstream_guard.UpstreamUnavailable("OpenAI request rate limit reached")
+
+        wait = None
+        try:
+            with metrics.UPSTREAM_IN_FLIGHT.track_inprogress():
+                response = session.post(
+                    CHAT_COMPLETIONS_URL,
+                    headers=headers,
+                    json=payload,
+                    timeout=(min(10, remaining), min(ATTEMPT_TIMEOUT, remaining)),
+                    stream=stream
+                )
+            metrics.UPSTREAM_RESPONSES.labels(str(response.status_code)).inc()
+            if response.status_code not in RETRY_STATUSES:
+                upstream_guard.breaker.record(True, probe)
+                return response
+            upstream_guard.breaker.record(False, probe)
+            print(f"OpenAI API returned {response.status_code} (attempt {attempt + 1}/{max_attempts})")
+            wait = _retry_after_seconds(response)
+            if attempt + 1 >= max_attempts:
+                return response
+            # Read the (small) error body so the connection goes back to the pool
+            response.content
+            last_response = response
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"OpenAI connection error (attempt {attempt + 1}/{max_attempts}): {e}")
+            metrics.UPSTREAM_ERRORS.inc()
+            upstream_guard.breaker.record(False, probe)
+            if attempt + 1 >= max_attempts:
+                raise
+            last_response = None
+
+        if upstream_guard.breaker.is_open():
+            # Other calls have already given up on the upstream; stop retrying
+            if last_response is not None:
+                return last_response
+            raise requests.ConnectionError("OpenAI circuit breaker opened")
+        if wait is None:
+            wait = _backoff(attempt)
+        if time.monotonic() + wait >= deadline_at:
+            # Not enough time left for another attempt
+            if last_response is not None:
+                return last_response
+            raise requests.Timeout("OpenAI request deadline exceeded")
+        time.sleep(wait)
+        attempt += 1
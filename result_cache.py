@@ -0,0 +1,108 @@
+# result_cache.py
+# Persistent, content-addressed cache for AI generation results.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import local_db
+import metrics
+
+CACHE_PATH = os.getenv('RESULT_CACHE_PATH', 'result_cache.db')
+CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+CACHE_MAX_AGE = int(os.getenv('RESULT_CACHE_MAX_AGE', 7 * 24 * 3600))
+
+_lock = threading.Lock()
+
+# Writes use sqlite3's implicit transactions and commit() explicitly
+_db = local_db.LocalDB(CACHE_PATH, [
+    '''CREATE TABLE IF NOT EXISTS results (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_results_accessed ON results(accessed_at)',
+], isolation_level='')
+
+
+def image_digest(image_paths):
+    """
+    Hashes the bytes of every image. Pass the result to make_key to build several keys
+    for the same photos without reading them again.
+    """
+    digest = hashlib.sha256()
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest
+
+
+def make_key(image_paths, *parts, digest=None):
+    """
+    Hashes the bytes of every image plus any extra parts (persona, model, prompt version).
+    """
+    digest = (digest or image_digest(image_paths)).copy()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get(key):
+    try:
+        conn = _db.connect()
+        row = conn.execute('SELECT value, created_at FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            metrics.CACHE_MISSES.inc()
+            return None
+        value, created_at = row
+        now = time.time()
+        if now - created_at > CACHE_MAX_AGE:
+            with _lock:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                conn.commit()
+            metrics.CACHE_MISSES.inc()
+            return None
+        with _lock:
+            conn.execute('UPDATE results SET accessed_at = ? WHERE key = ?', (now, key))
+            conn.commit()
+        metrics.CACHE_HITS.inc()
+        return json.loads(value)
+    except Exception as e:
+        print(f"Result cache read error: {e}")
+        return None
+
+
+def put(key, value):
+    try:
+        conn = _db.connect()
+        encoded = json.dumps(value)
+        now = time.time()
+        with _lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, encoded, len(encoded), now, now)
+            )
+            _evict(conn, now)
+            conn.commit()
+    except Exception as e:
+        print(f"Result cache write error: {e}")
+
+
+def _evict(conn, now):
+    # Drop expired entries first, then the least recently used until under the size budget
+    conn.execute('DELETE FROM results WHERE created_at < ?', (now - CACHE_MAX_AGE,))
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    for key, size in conn.execute('SELECT key, size FROM results ORDER BY accessed_at').fetchall():
+        if total <= CACHE_MAX_BYTES:
+            break
+        conn.execute('DELETE FROM results WHERE key = ?', (key,))
+        total -= size
@@ -0,0 +1,152 @@
+# scheduler.py
+# Dispatches scheduled social posts when they fall due.
+#
+# Upcoming posts sit in an in-memory min-heap ordered by due time, filled from the
+# (status, due_at) index. The dispatcher thread sleeps until exactly the next due time
+# (or until a new post is scheduled) instead of polling every row. Delivery is claimed
+# atomically in the database, so several gunicorn workers can run a dispatcher without
+# publishing the same post twice.
+
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import datastore
+
+DISPATCH_WORKERS = int(os.getenv('SOCIAL_DISPATCH_WORKERS', 4))
+MAX_ATTEMPTS = int(os.getenv('SOCIAL_DISPATCH_MAX_ATTEMPTS', 5))
+# How far ahead to load posts into the heap, and how often to reload it (for posts
+# scheduled through another worker process)
+LOOKAHEAD = 3600
+REFILL_INTERVAL = 60
+HEAP_BATCH = 1000
+# A claim older than this is assumed to belong to a crashed worker
+CLAIM_LEASE = 300
+RETRY_BASE = 60
+
+
+class LogPublisher:
+    """
+    Default publisher: records the post in the log. Real networks implement
+    publish(post, idempotency_key) and return the id the network assigned.
+    """
+
+    def publish(self, post, idempotency_key):
+        print(f"Publishing social post {post['id']} for {post['user']}: '{post['content'][:70]}'")
+        return idempotency_key
+
+
+class Dispatcher:
+
+    def __init__(self, publisher=None, workers=DISPATCH_WORKERS):
+        self.publisher = publisher or LogPublisher()
+        self._heap = []
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='social-dispatch')
+        self._slots = threading.BoundedSemaphore(workers)
+        self._thread = None
+        self._next_refill = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='social-scheduler', daemon=True)
+            self._thread.start()
+
+    def notify(self, post_id, due_at):
+        """
+        Adds a newly scheduled post and wakes the dispatcher if it is now the earliest.
+        """
+        if due_at > time.time() + LOOKAHEAD:
+            return  # Picked up by a later refill
+        with self._condition:
+            if post_id not in self._queued:
+                heapq.heappush(self._heap, (due_at, post_id))
+                self._queued.add(post_id)
+                self._condition.notify()
+
+    def _refill(self, store, now):
+        store.release_stale_claims(now - CLAIM_LEASE)
+        upcoming = store.next_due_social_posts(now + LOOKAHEAD, HEAP_BATCH)
+        with self._condition:
+            for due_at, post_id in upcoming:
+                if post_id not in self._queued:
+                    heapq.heappush(self._heap, (due_at, post_id))
+                    self._queued.add(post_id)
+        self._next_refill = now + REFILL_INTERVAL
+
+    def _run(self):
+        while True:
+            try:
+                store = datastore.get_store()
+                now = time.time()
+                if now >= self._next_refill:
+                    self._refill(store, now)
+
+                due = []
+                with self._condition:
+                    while self._heap and self._heap[0][0] <= now:
+                        due_at, post_id = heapq.heappop(self._heap)
+                        self._queued.discard(post_id)
+                        due.append(post_id)
+                    if not due:
+                        next_due = self._heap[0][0] if self._heap else float('inf')
+                        self._condition.wait(timeout=max(0, min(next_due, self._next_refill) - now))
+                        continue
+
+                for post_id in due:
+                    # Bounded concurrency: wait for a free publishing slot
+                    self._slots.acquire()
+                    self._executor.submit(self._dispatch, post_id)
+            except Exception as e:
+                print(f"Social scheduler error: {e}")
+                time.sleep(5)
+
+    def _dispatch(self, post_id):
+        try:
+            store = datastore.get_store()
+            post = store.claim_social_post(post_id, time.time())
+            if post is None:
+                return  # Already published, rescheduled, or claimed by another worker
+            try:
+                external_id = self.publisher.publish(post, f"social-post-{post_id}")
+                store.finish_social_post(post_id, 'published', external_id=external_id)
+            except Exception as e:
+                print(f"Publishing social post {post_id} failed (attempt {post['attempts']}): {e}")
+                if post['attempts'] >= MAX_ATTEMPTS:
+                    store.finish_social_post(post_id, 'failed', error=str(e))
+                else:
+                    retry_at = time.time() + RETRY_BASE * (2 ** (post['attempts'] - 1))
+                    store.finish_social_post(post_id, 'scheduled', error=str(e), retry_at=retry_at)
+                    self.notify(post_id, retry_at)
+        except Exception as e:
+            print(f"Social dispatch error for post {post_id}: {e}")
+        finally:
+            self._slots.release()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher()
+    return _dispatcher
+
+
+def set_publisher(publisher):
+    get_dispatcher().publisher = publisher
+
+
+def start():
+    get_dispatcher().start()
+
+
+def notify(post_id, due_at):
+    get_dispatcher().notify(post_id, due_at)
@@ -0,0 +1,61 @@
+# scrape_cache.py
+# Persistent cache of scraped profile bios and posts, keyed by normalized profile URL.
+
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+import local_db
+
+CACHE_PATH = os.getenv('SCRAPE_CACHE_PATH', 'scrape_cache.db')
+SCRAPE_CACHE_TTL = int(os.getenv('SCRAPE_CACHE_TTL', 6 * 3600))
+
+_db = local_db.LocalDB(CACHE_PATH, [
+    '''CREATE TABLE IF NOT EXISTS profiles (
+        url TEXT PRIMARY KEY,
+        bio TEXT,
+        posts TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    )''',
+])
+
+
+def normalize_profile_url(profile_url):
+    """
+    Reduces the many spellings of a profile URL (scheme, m./www. host, trailing slash,
+    tracking query strings) to one cache key. profile.php?id= URLs keep their id.
+    """
+    parsed = urlparse(profile_url.strip() if '://' in profile_url else f'https://{profile_url.strip()}')
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'mobile.', 'web.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parsed.path.rstrip('/').lower() or '/'
+    if path.endswith('/profile.php'):
+        ids = [part for part in parsed.query.split('&') if part.startswith('id=')]
+        if ids:
+            path = f"{path}?{ids[0]}"
+    return f"{host}{path}"
+
+
+def get(profile_url):
+    """
+    Returns (entry, is_fresh) or (None, False). entry has 'bio', 'posts' and 'fetched_at'.
+    """
+    row = _db.connect().execute(
+        'SELECT bio, posts, fetched_at FROM profiles WHERE url = ?', (normalize_profile_url(profile_url),)
+    ).fetchone()
+    if row is None:
+        return None, False
+    bio, posts, fetched_at = row
+    entry = {'bio': bio, 'posts': json.loads(posts), 'fetched_at': fetched_at}
+    return entry, time.time() - fetched_at < SCRAPE_CACHE_TTL
+
+
+def put(profile_url, bio, posts):
+    _db.connect().execute(
+        'INSERT OR REPLACE INTO profiles (url, bio, posts, fetched_at) VALUES (?, ?, ?, ?)',
+        (normalize_profile_url(profile_url), bio, json.dumps(posts), time.time())
+    )
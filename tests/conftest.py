@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_db
+
+
+class FakeClock:
+    """
+    Stands in for the time module: time() returns the fake now and sleep() advances it.
+    """
+
+    def __init__(self, start=1_000_000.0):
+        self.now = start
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """
+    Points a module's LocalDB at an empty database file under tmp_path.
+    """
+    def repoint(module):
+        db = module._db
+        monkeypatch.setattr(module, '_db', local_db.LocalDB(
+            str(tmp_path / f'{module.__name__}.db'), db.schema, db.setup, db.isolation_level
+        ))
+        return module._db
+    return repoint
@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+import batching
+import upstream_guard
+
+
+@pytest.fixture(autouse=True)
+def budget(fresh_db, monkeypatch):
+    fresh_db(upstream_guard)
+    monkeypatch.setattr(batching, 'PACING_POLL', 0.01)
+    bucket = upstream_guard.TokenBucket('test_tokens', per_minute=60)
+    monkeypatch.setattr(batching, 'budget', bucket)
+    return bucket
+
+
+def test_run_yields_results_and_errors_by_index():
+    def work(item):
+        if item == 'bad':
+            raise ValueError(item)
+        return item.upper()
+
+    results = {index: (result, error) for index, result, error in batching.run(['a', 'bad', 'c'], work)}
+    assert results[0] == ('A', None)
+    assert results[2] == ('C', None)
+    assert isinstance(results[1][1], ValueError)
+
+
+def test_run_takes_budget_before_submitting(budget, clock, monkeypatch):
+    monkeypatch.setattr(upstream_guard, 'time', clock)
+    budget.acquire(60, max_wait=0)
+    started = []
+
+    def work(item):
+        started.append(item)
+        return item
+
+    results = []
+    runner = threading.Thread(target=lambda: results.extend(batching.run(['a', 'b'], work, cost=lambda item: 1)))
+    runner.start()
+    runner.join(0.2)
+    # With the bucket empty nothing reaches a generation thread
+    assert runner.is_alive()
+    assert started == []
+    clock.advance(2)
+    runner.join(5)
+    assert sorted(results) == [(0, 'a', None), (1, 'b', None)]
+
+
+def test_run_skips_budget_for_free_items_and_reports_cost_errors(budget):
+    budget.acquire(60, max_wait=0)
+
+    def cost(item):
+        if item == 'bad':
+            raise ValueError(item)
+        return 0
+
+    results = {index: (result, error) for index, result, error in batching.run(['a', 'bad'], lambda item: item, cost=cost)}
+    assert results[0] == ('a', None)
+    assert isinstance(results[1][1], ValueError)
+
@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+import local_db
+import trial_ledger
+
+
+@pytest.fixture(autouse=True)
+def ledger(fresh_db, monkeypatch):
+    db = fresh_db(trial_ledger)
+    monkeypatch.setattr(db, 'setup', None)  # No legacy file import
+    monkeypatch.setattr(trial_ledger, '_known_used', set())
+    return db
+
+
+def claim_concurrently(ip_hash, callers, before_claim=None):
+    barrier = threading.Barrier(callers)
+    results = []
+    results_lock = threading.Lock()
+
+    def claim():
+        barrier.wait()
+        if before_claim:
+            before_claim()
+        claimed = trial_ledger.claim(ip_hash)
+        with results_lock:
+            results.append(claimed)
+
+    threads = [threading.Thread(target=claim) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_claims_spend_the_trial_once():
+    results = claim_concurrently('abc', callers=2)
+    assert sorted(results) == [False, True]
+    assert trial_ledger.has_used('abc')
+
+
+def test_many_concurrent_claims_spend_the_trial_once():
+    results = claim_concurrently('abc', callers=16)
+    assert results.count(True) == 1
+
+
+def test_claims_from_separate_workers_spend_the_trial_once():
+    # Other gunicorn workers do not share the in-memory set; only the database decides
+    results = claim_concurrently('abc', callers=8, before_claim=trial_ledger._known_used.clear)
+    assert results.count(True) == 1
+
+
+def test_released_trial_can_be_claimed_again():
+    assert trial_ledger.claim('abc')
+    trial_ledger.release('abc')
+    assert not trial_ledger.has_used('abc')
+    assert trial_ledger.claim('abc')
+
+
+def test_legacy_file_is_imported_once(ledger, tmp_path, monkeypatch):
+    legacy = tmp_path / 'free_trials_used.txt'
+    legacy.write_text('abc\ndef\n\n')
+    monkeypatch.setattr(trial_ledger, 'LEGACY_TRIAL_FILE', str(legacy))
+    monkeypatch.setattr(trial_ledger, '_initialized', False)
+    conn = local_db.open_connection(ledger.path)
+    for statement in ledger.schema:
+        conn.execute(statement)
+    trial_ledger._import_legacy_file(conn)
+    assert trial_ledger.has_used('abc') and trial_ledger.has_used('def')
+
+    # Another worker starting later finds the import recorded and skips the file
+    trial_ledger.release('abc')
+    monkeypatch.setattr(trial_ledger, '_initialized', False)
+    trial_ledger._import_legacy_file(conn)
+    assert not trial_ledger.has_used('abc')
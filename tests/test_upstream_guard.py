@@ -0,0 +1,151 @@
+import pytest
+
+import upstream_guard
+from upstream_guard import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, TokenBucket, UpstreamUnavailable
+
+
+@pytest.fixture(autouse=True)
+def guard(fresh_db, clock, monkeypatch):
+    fresh_db(upstream_guard)
+    monkeypatch.setattr(upstream_guard, 'time', clock)
+
+
+# --- TokenBucket ---
+
+def test_bucket_starts_full_and_empties():
+    bucket = TokenBucket('test', per_minute=60)
+    assert bucket.acquire(60, max_wait=0)
+    assert not bucket.acquire(1, max_wait=0)
+
+
+def test_bucket_refills_at_rate(clock):
+    bucket = TokenBucket('test', per_minute=60)
+    assert bucket.acquire(60, max_wait=0)
+    clock.advance(10)
+    assert bucket.acquire(10, max_wait=0)
+    assert not bucket.acquire(1, max_wait=0)
+
+
+def test_bucket_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket('test', per_minute=60)
+    clock.advance(3600)
+    assert bucket.acquire(60, max_wait=0)
+    assert not bucket.acquire(1, max_wait=0)
+
+
+def test_bucket_acquire_waits_for_refill(clock):
+    bucket = TokenBucket('test', per_minute=60)
+    assert bucket.acquire(60)
+    assert bucket.acquire(5)
+    assert clock.slept == pytest.approx(5)
+
+
+def test_bucket_gives_up_past_max_wait_without_taking_tokens(clock):
+    bucket = TokenBucket('test', per_minute=60)
+    assert bucket.acquire(60)
+    assert not bucket.acquire(30, max_wait=10)
+    assert clock.slept == 0
+    # The refused request left the bucket untouched
+    clock.advance(30)
+    assert bucket.acquire(30, max_wait=0)
+
+
+def test_bucket_is_shared_by_name():
+    TokenBucket('shared', per_minute=60).acquire(60)
+    assert not TokenBucket('shared', per_minute=60).acquire(1, max_wait=0)
+    assert TokenBucket('other', per_minute=60).acquire(1, max_wait=0)
+
+
+# --- CircuitBreaker ---
+
+def make_breaker():
+    return CircuitBreaker('test', failure_threshold=3, cooldown=30, probe_successes=2, probe_timeout=90)
+
+
+def trip(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow() is False
+        breaker.record(False)
+
+
+def test_breaker_stays_closed_below_threshold():
+    breaker = make_breaker()
+    breaker.record(False)
+    breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.status() == {'state': CLOSED, 'failures': 2}
+    assert breaker.allow() is False
+
+
+def test_breaker_opens_and_fails_fast():
+    breaker = make_breaker()
+    trip(breaker)
+    assert breaker.status()['state'] == OPEN
+    assert breaker.is_open()
+    with pytest.raises(UpstreamUnavailable):
+        breaker.allow()
+
+
+def test_breaker_half_opens_after_cooldown_with_one_probe(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.allow() is True
+    assert breaker.status()['state'] == HALF_OPEN
+    # Only one probe at a time
+    with pytest.raises(UpstreamUnavailable):
+        breaker.allow()
+
+
+def test_breaker_closes_after_successful_probes(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.allow() is True
+    breaker.record(True, probe=True)
+    assert breaker.status()['state'] == HALF_OPEN
+    assert breaker.allow() is True
+    breaker.record(True, probe=True)
+    assert breaker.status() == {'state': CLOSED, 'failures': 0}
+    assert breaker.allow() is False
+
+
+def test_breaker_reopens_on_failed_probe(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.allow() is True
+    breaker.record(False, probe=True)
+    assert breaker.status()['state'] == OPEN
+    clock.advance(29)
+    with pytest.raises(UpstreamUnavailable):
+        breaker.allow()
+    clock.advance(1)
+    assert breaker.allow() is True
+
+
+def test_breaker_released_probe_frees_the_slot(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.allow() is True
+    breaker.release(True)
+    assert breaker.allow() is True
+
+
+def test_breaker_lost_probe_times_out(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(30)
+    assert breaker.allow() is True
+    clock.advance(90)
+    assert breaker.allow() is True
+
+
+def test_breaker_ignores_late_results_while_open():
+    breaker = make_breaker()
+    trip(breaker)
+    breaker.record(True)
+    assert breaker.status()['state'] == OPEN
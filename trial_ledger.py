@@ -0,0 +1,81 @@
+# trial_ledger.py
+# Indexed ledger of client hashes that have used their free trial.
+
+import os
+import threading
+
+import local_db
+
+LEDGER_PATH = os.getenv('TRIAL_LEDGER_PATH', 'free_trials.db')
+LEGACY_TRIAL_FILE = 'free_trials_used.txt'
+
+_init_lock = threading.Lock()
+_initialized = False
+
+# Trials are never un-used (apart from a failed claim being released straight away), so
+# a hash seen once can be answered from memory without touching the database again.
+_known_used = set()
+_known_lock = threading.Lock()
+
+
+def _import_legacy_file(conn):
+    # The import is recorded in the ledger itself, so only the first worker on the host
+    # reads the file, and all of it lands in one transaction or none does
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        with local_db.immediate(conn):
+            done = conn.execute('SELECT 1 FROM imports WHERE source = ?', (LEGACY_TRIAL_FILE,)).fetchone()
+            if not done and os.path.exists(LEGACY_TRIAL_FILE):
+                with open(LEGACY_TRIAL_FILE, 'r') as f:
+                    hashes = [(line.strip(),) for line in f if line.strip()]
+                conn.executemany('INSERT OR IGNORE INTO trials (ip_hash) VALUES (?)', hashes)
+                conn.execute('INSERT INTO imports (source) VALUES (?)', (LEGACY_TRIAL_FILE,))
+                print(f"Imported {len(hashes)} entries from {LEGACY_TRIAL_FILE}")
+        _initialized = True
+
+
+_db = local_db.LocalDB(LEDGER_PATH, [
+    '''CREATE TABLE IF NOT EXISTS trials (
+        ip_hash TEXT PRIMARY KEY,
+        used_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS imports (
+        source TEXT PRIMARY KEY,
+        imported_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID''',
+], setup=_import_legacy_file)
+
+
+def has_used(ip_hash):
+    if ip_hash in _known_used:
+        return True
+    row = _db.connect().execute('SELECT 1 FROM trials WHERE ip_hash = ?', (ip_hash,)).fetchone()
+    if row:
+        with _known_lock:
+            _known_used.add(ip_hash)
+        return True
+    return False
+
+
+def claim(ip_hash):
+    """
+    Atomically marks the trial as used. Returns True only for the one caller that
+    actually claimed it, so concurrent requests from any worker cannot double-spend.
+    """
+    if ip_hash in _known_used:
+        return False
+    cursor = _db.connect().execute('INSERT OR IGNORE INTO trials (ip_hash) VALUES (?)', (ip_hash,))
+    with _known_lock:
+        _known_used.add(ip_hash)
+    return cursor.rowcount == 1
+
+
+def release(ip_hash):
+    """
+    Gives back a trial claimed by a request that then failed.
+    """
+    _db.connect().execute('DELETE FROM trials WHERE ip_hash = ?', (ip_hash,))
+    with _known_lock:
+        _known_used.discard(ip_hash)
@@ -0,0 +1,413 @@
+# upload_store.py
+# Content-addressed storage for uploaded images.
+#
+# Uploads are streamed to a temp file while they are hashed and sniffed, then moved to
+# a name derived from their SHA-256, so the same photo uploaded twice is stored once.
+# Files live in a two-level sharded layout (ab/cd/abcd....jpg), each owner has a byte
+# quota, and a background sweeper removes uploads that have not been used for a while.
+
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+import local_db
+import metrics
+
+INDEX_PATH = os.getenv('UPLOAD_INDEX_PATH', 'uploads.db')
+TMP_DIRNAME = '.incoming'
+
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', 3 * 24 * 3600))
+UPLOAD_QUOTA_BYTES = int(os.getenv('UPLOAD_QUOTA_BYTES', 200 * 1024 * 1024))
+SWEEP_INTERVAL = int(os.getenv('UPLOAD_SWEEP_INTERVAL', 15 * 60))
+# Temp and unindexed files younger than this may still belong to an in-flight request
+ORPHAN_GRACE = 3600
+
+_CONTENT_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+
+# Enough leading bytes to recognise every supported format
+SNIFF_BYTES = 12
+
+
+def detect_image_type(header):
+    """
+    Returns the file extension for the image format in header, or None if it isn't one we accept.
+    """
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class HashingUploadStream:
+    """
+    Writable file object handed to the multipart parser. Each chunk is hashed and written
+    to disk as it arrives; writing stops as soon as the part is known to be too large or
+    not an image.
+    """
+
+    def __init__(self, upload_folder, max_bytes):
+        tmp_dir = os.path.join(upload_folder, TMP_DIRNAME)
+        os.makedirs(tmp_dir, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=tmp_dir, prefix='upload-', delete=False)
+        self.path = self._file.name
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.header = b''
+        self.image_type = None
+        self.error = None
+        self.committed = False
+
+    def _reject(self, error):
+        self.error = error
+        self._discard()
+
+    def _discard(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, data):
+        if self.error:
+            return len(data)
+
+        if len(self.header) < SNIFF_BYTES:
+            self.header += data[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= SNIFF_BYTES:
+                self.image_type = detect_image_type(self.header)
+                if not self.image_type:
+                    self._reject('File is not a supported image')
+                    return len(data)
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self._reject(f'File is larger than {self.max_bytes // (1024 * 1024)}MB')
+            return len(data)
+
+        self.digest.update(data)
+        self._file.write(data)
+        return len(data)
+
+    def finish(self):
+        """
+        Called once the part has been fully received. Returns True if it is a valid image.
+        """
+        if not self.error and not self.image_type:
+            self.image_type = detect_image_type(self.header)
+            if not self.image_type:
+                self._reject('File is not a supported image')
+        if not self.error:
+            self._file.flush()
+        return self.error is None
+
+    # The parser seeks back to the start once a part is complete
+    def seek(self, offset, whence=0):
+        if self._file.closed:
+            return 0
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        if self._file.closed:
+            return b''
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        if self._file.closed:
+            return b''
+        return self._file.readline(size)
+
+    def close(self):
+        # Anything not moved into the store by the end of the request is temp garbage
+        if not self.committed:
+            self._discard()
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+BLOBS_SCHEMA = '''CREATE TABLE IF NOT EXISTS {table} (
+    filename TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+)'''
+
+
+def _has_refcount(conn):
+    return 'refcount' in {row[1] for row in conn.execute('PRAGMA table_info(blobs)')}
+
+
+def _drop_refcount(conn):
+    # Older indexes kept a blobs.refcount that nothing read; refs records who holds a blob.
+    # The column is NOT NULL without a default, so the table is rebuilt without it.
+    if not _has_refcount(conn):
+        return
+    with local_db.immediate(conn):
+        # Another worker may have rebuilt it while this one waited for the lock
+        if _has_refcount(conn):
+            conn.execute(BLOBS_SCHEMA.format(table='blobs_new'))
+            conn.execute('''INSERT INTO blobs_new (filename, size, created_at, last_used_at)
+                            SELECT filename, size, created_at, last_used_at FROM blobs''')
+            conn.execute('DROP TABLE blobs')
+            conn.execute('ALTER TABLE blobs_new RENAME TO blobs')
+
+
+def _migrate(conn):
+    _drop_refcount(conn)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_blobs_last_used ON blobs(last_used_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_refs_filename ON refs(filename)')
+
+
+_db = local_db.LocalDB(INDEX_PATH, [
+    BLOBS_SCHEMA.format(table='blobs'),
+    '''CREATE TABLE IF NOT EXISTS refs (
+        owner TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (owner, filename)
+    )''',
+], setup=_migrate)
+
+
+def storage_path(upload_folder, filename):
+    """
+    Maps a public upload name to its location on disk, or None if the name is unsafe.
+    Content-addressed names are sharded by hash prefix; older uuid names stay flat.
+    """
+    if not filename or '/' in filename or '\\' in filename or filename.startswith('.'):
+        return None
+    if _CONTENT_NAME.match(filename):
+        return os.path.join(upload_folder, filename[:2], filename[2:4], filename)
+    return os.path.join(upload_folder, filename)
+
+
+def content_hash(filename):
+    """
+    Returns the SHA-256 embedded in a content-addressed upload name, or None for legacy names.
+    """
+    if filename and _CONTENT_NAME.match(filename):
+        return filename.split('.', 1)[0]
+    return None
+
+
+def commit(stream, upload_folder, owner):
+    """
+    Moves a finished upload to its content-addressed name and records a reference from owner.
+    Returns (filename, path, deduplicated). Raises QuotaExceeded if owner is over its quota.
+    """
+    filename = f"{stream.digest.hexdigest()}.{stream.image_type}"
+    path = storage_path(upload_folder, filename)
+    stream._file.close()
+
+    conn = _db.connect()
+    now = time.time()
+    with local_db.immediate(conn):
+        already_owned = conn.execute(
+            'SELECT 1 FROM refs WHERE owner = ? AND filename = ?', (owner, filename)
+        ).fetchone()
+        if not already_owned:
+            used = conn.execute('SELECT COALESCE(SUM(size), 0) FROM refs WHERE owner = ?', (owner,)).fetchone()[0]
+            if used + stream.size > UPLOAD_QUOTA_BYTES:
+                raise QuotaExceeded(f'Upload quota of {UPLOAD_QUOTA_BYTES // (1024 * 1024)}MB exceeded')
+
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            os.remove(stream.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(stream.path, path)
+        stream.committed = True
+
+        conn.execute(
+            '''INSERT INTO blobs (filename, size, created_at, last_used_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT(filename) DO UPDATE SET last_used_at = excluded.last_used_at''',
+            (filename, stream.size, now, now)
+        )
+        if not already_owned:
+            conn.execute(
+                'INSERT INTO refs (owner, filename, size, created_at) VALUES (?, ?, ?, ?)',
+                (owner, filename, stream.size, now)
+            )
+    return filename, path, deduplicated
+
+
+def touch(filenames):
+    """
+    Marks uploads as recently used so the sweeper keeps them.
+    """
+    try:
+        now = time.time()
+        _db.connect().executemany(
+            'UPDATE blobs SET last_used_at = ? WHERE filename = ?', [(now, name) for name in filenames]
+        )
+    except Exception as e:
+        print(f"Upload index error: {e}")
+
+
+# --- Garbage collection ---
+
+def _delete_with_derivatives(path):
+    # Remove the original plus any derived copies (vision JPEG, thumbnails) stored next to it
+    reclaimed = 0
+    deleted = 0
+    for candidate in [path] + glob.glob(glob.escape(path) + '.*'):
+        try:
+            size = os.path.getsize(candidate)
+            os.remove(candidate)
+            reclaimed += size
+            deleted += 1
+        except FileNotFoundError:
+            continue
+    return deleted, reclaimed
+
+
+def sweep(upload_folder):
+    """
+    Deletes uploads unused for UPLOAD_TTL, unindexed files and stale temp files.
+    Returns (files_deleted, bytes_reclaimed).
+    """
+    started = time.time()
+    conn = _db.connect()
+    deleted = 0
+    reclaimed = 0
+
+    expired = conn.execute(
+        'SELECT filename FROM blobs WHERE last_used_at < ?', (started - UPLOAD_TTL,)
+    ).fetchall()
+    for (filename,) in expired:
+        # The file is removed while holding the write lock that commit() also takes, so a
+        # concurrent upload of the same bytes either lands before (and keeps the blob) or
+        # after (and writes the file again)
+        with local_db.immediate(conn):
+            # Re-check under the write lock in case the file was re-uploaded meanwhile
+            removed = conn.execute(
+                'DELETE FROM blobs WHERE filename = ? AND last_used_at < ?', (filename, started - UPLOAD_TTL)
+            ).rowcount
+            if removed:
+                conn.execute('DELETE FROM refs WHERE filename = ?', (filename,))
+                files, size = _delete_with_derivatives(storage_path(upload_folder, filename))
+                deleted += files
+                reclaimed += size
+
+    # Files on disk that the index doesn't know about (crashed requests, legacy uuid uploads)
+    for root, dirs, files in os.walk(upload_folder):
+        dirs[:] = [d for d in dirs if d != TMP_DIRNAME]
+        names = set(files)
+        for name in files:
+            if name.startswith('.'):
+                continue
+            # Derived copies (name.ext.vision.jpg, ...) are removed together with their original
+            if any(name[:i] in names for i, char in enumerate(name) if char == '.' and i > 0):
+                continue
+            indexed = _CONTENT_NAME.match(name) is not None
+            if indexed and conn.execute('SELECT 1 FROM blobs WHERE filename = ?', (name,)).fetchone():
+                continue
+            path = os.path.join(root, name)
+            try:
+                age = started - os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            # Legacy uploads have no usage record, so they get the full TTL from their mtime
+            if age < (ORPHAN_GRACE if indexed else UPLOAD_TTL):
+                continue
+            if not indexed:
+                files_removed, size = _delete_with_derivatives(path)
+            else:
+                # Same lock as above: commit() may be indexing this very file right now
+                with local_db.immediate(conn):
+                    files_removed, size = 0, 0
+                    if not conn.execute('SELECT 1 FROM blobs WHERE filename = ?', (name,)).fetchone():
+                        files_removed, size = _delete_with_derivatives(path)
+            deleted += files_removed
+            reclaimed += size
+
+    tmp_dir = os.path.join(upload_folder, TMP_DIRNAME)
+    for path in glob.glob(os.path.join(tmp_dir, 'upload-*')):
+        try:
+            if started - os.path.getmtime(path) > ORPHAN_GRACE:
+                size = os.path.getsize(path)
+                os.remove(path)
+                deleted += 1
+                reclaimed += size
+        except FileNotFoundError:
+            continue
+
+    metrics.UPLOAD_SWEEPS.inc()
+    metrics.UPLOAD_SWEEP_FILES.inc(deleted)
+    metrics.UPLOAD_SWEEP_BYTES.inc(reclaimed)
+    metrics.UPLOAD_SWEEP_STARTED.set(started)
+    metrics.UPLOAD_SWEEP_DURATION.set(time.time() - started)
+    if deleted:
+        print(f"Upload sweep removed {deleted} files, reclaimed {reclaimed} bytes")
+    return deleted, reclaimed
+
+
+def _sweep_loop(upload_folder):
+    lock_path = os.path.join(upload_folder, '.sweep.lock')
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            # Only one gunicorn worker sweeps at a time
+            with open(lock_path, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                sweep(upload_folder)
+        except Exception as e:
+            print(f"Upload sweep error: {e}")
+
+
+_sweeper = None
+
+
+def start_sweeper(upload_folder):
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep_loop, args=(upload_folder,), name='upload-sweeper', daemon=True)
+        _sweeper.start()
+
+
+def _last_sweep():
+    # Each worker sweeps on its own timer; report whichever sweep started last
+    started = {sample.labels.get('pid'): sample.value for sample in metrics.samples(metrics.UPLOAD_SWEEP_STARTED)}
+    started = {pid: value for pid, value in started.items() if value}
+    if not started:
+        return None, None
+    pid = max(started, key=started.get)
+    durations = {sample.labels.get('pid'): sample.value for sample in metrics.samples(metrics.UPLOAD_SWEEP_DURATION)}
+    duration = durations.get(pid)
+    return started[pid], round(duration, 3) if duration is not None else None
+
+
+def stats(owner=None):
+    # Sweep totals come from the Prometheus metrics, which cover every worker
+    result = {
+        'sweeps': int(metrics.total(metrics.UPLOAD_SWEEPS)),
+        'files_deleted': int(metrics.total(metrics.UPLOAD_SWEEP_FILES)),
+        'bytes_reclaimed': int(metrics.total(metrics.UPLOAD_SWEEP_BYTES)),
+    }
+    result['last_sweep_at'], result['last_sweep_seconds'] = _last_sweep()
+    conn = _db.connect()
+    result['indexed_files'], result['indexed_bytes'] = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs'
+    ).fetchone()
+    if owner is not None:
+        result['owner_bytes'] = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM refs WHERE owner = ?', (owner,)
+        ).fetchone()[0]
+        result['owner_quota_bytes'] = UPLOAD_QUOTA_BYTES
+    return result
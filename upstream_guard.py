@@ -0,0 +1,187 @@
+# upstream_guard.py
+# Rate limiting and circuit breaking for OpenAI calls.
+#
+# State lives in a small SQLite database, so every gunicorn worker on the host shares
+# one request budget and one view of whether the upstream is healthy. Each check is a
+# single short BEGIN IMMEDIATE transaction.
+
+import os
+import time
+
+import local_db
+
+GUARD_PATH = os.getenv('UPSTREAM_GUARD_PATH', 'upstream_guard.db')
+REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_RPM_LIMIT', 500))
+# Longest a call will queue for a request slot before giving up and using the fallback
+LIMITER_MAX_WAIT = float(os.getenv('OPENAI_LIMITER_MAX_WAIT', 5))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+BREAKER_PROBE_SUCCESSES = int(os.getenv('BREAKER_PROBE_SUCCESSES', 2))
+# A probe that has not reported back by now is assumed lost with its worker
+BREAKER_PROBE_TIMEOUT = float(os.getenv('OPENAI_DEADLINE', 90))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+_db = local_db.LocalDB(GUARD_PATH, [
+    '''CREATE TABLE IF NOT EXISTS buckets (
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS breakers (
+        name TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        failures INTEGER NOT NULL DEFAULT 0,
+        successes INTEGER NOT NULL DEFAULT 0,
+        opened_at REAL,
+        probe_at REAL
+    ) WITHOUT ROWID''',
+])
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at per_minute, shared across processes.
+    """
+
+    def __init__(self, name, per_minute):
+        self.name = name
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+
+    def _take(self, amount):
+        # Returns 0 if the tokens were taken, otherwise the seconds until they will be there
+        now = time.time()
+        with _db.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            tokens = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) / self.rate
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                         (self.name, tokens, now))
+        return wait
+
+    def acquire(self, amount=1, max_wait=None):
+        """
+        Blocks until amount tokens are taken. Returns False without taking any if that
+        would take longer than max_wait seconds.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            wait = self._take(amount)
+            if wait == 0:
+                return True
+            if max_wait is not None and waited + wait > max_wait:
+                return False
+            # Re-check at least once a second: other workers may be competing for the same tokens
+            step = min(wait, 1.0)
+            time.sleep(step)
+            waited += step
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive upstream failures. While open, calls fail
+    fast with UpstreamUnavailable. After cooldown one probe call at a time is let
+    through; probe_successes successful probes close it, a failed probe re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 probe_successes=BREAKER_PROBE_SUCCESSES, probe_timeout=BREAKER_PROBE_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe_successes = probe_successes
+        self.probe_timeout = probe_timeout
+
+    def _load(self, conn):
+        row = conn.execute(
+            'SELECT state, failures, successes, opened_at, probe_at FROM breakers WHERE name = ?', (self.name,)
+        ).fetchone()
+        if row is None:
+            return {'state': CLOSED, 'failures': 0, 'successes': 0, 'opened_at': None, 'probe_at': None}
+        return dict(zip(('state', 'failures', 'successes', 'opened_at', 'probe_at'), row))
+
+    def _save(self, conn, state):
+        conn.execute(
+            '''INSERT OR REPLACE INTO breakers (name, state, failures, successes, opened_at, probe_at)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (self.name, state['state'], state['failures'], state['successes'], state['opened_at'], state['probe_at'])
+        )
+
+    def allow(self):
+        """
+        Returns True if the call is a probe, False for a normal call. Raises
+        UpstreamUnavailable while the breaker is open or another probe is in flight.
+        """
+        # Healthy path is a plain read; only state changes take the write lock
+        if self._load(_db.connect())['state'] == CLOSED:
+            return False
+        now = time.time()
+        with _db.transaction() as conn:
+            state = self._load(conn)
+            if state['state'] == CLOSED:
+                return False
+            if state['state'] == OPEN:
+                if now - state['opened_at'] < self.cooldown:
+                    raise UpstreamUnavailable("OpenAI circuit breaker is open")
+                state.update(state=HALF_OPEN, successes=0)
+            elif state['probe_at'] is not None and now - state['probe_at'] < self.probe_timeout:
+                raise UpstreamUnavailable("OpenAI circuit breaker is waiting on a probe")
+            state['probe_at'] = now
+            self._save(conn, state)
+        return True
+
+    def record(self, ok, probe=False):
+        now = time.time()
+        with _db.transaction() as conn:
+            state = self._load(conn)
+            if state['state'] == CLOSED:
+                state['failures'] = 0 if ok else state['failures'] + 1
+                if state['failures'] >= self.failure_threshold:
+                    print(f"Opening {self.name} circuit breaker after {state['failures']} failures")
+                    state.update(state=OPEN, opened_at=now)
+            elif state['state'] == HALF_OPEN and probe:
+                if not ok:
+                    print(f"{self.name} probe failed, circuit breaker stays open")
+                    state.update(state=OPEN, opened_at=now, successes=0, probe_at=None)
+                elif state['successes'] + 1 >= self.probe_successes:
+                    print(f"Closing {self.name} circuit breaker")
+                    state.update(state=CLOSED, failures=0, successes=0, opened_at=None, probe_at=None)
+                else:
+                    state.update(successes=state['successes'] + 1, probe_at=None)
+            else:
+                return  # Late results from calls started before the breaker opened
+            self._save(conn, state)
+
+    def release(self, probe):
+        # The call ended without an upstream verdict (e.g. rate limited locally); free the probe slot
+        if not probe:
+            return
+        with _db.transaction() as conn:
+            state = self._load(conn)
+            if state['state'] == HALF_OPEN:
+                state['probe_at'] = None
+                self._save(conn, state)
+
+    def is_open(self):
+        return self._load(_db.connect())['state'] != CLOSED
+
+    def status(self):
+        state = self._load(_db.connect())
+        return {'state': state['state'], 'failures': state['failures']}
+
+
+requests_per_minute = TokenBucket('openai_requests', REQUESTS_PER_MINUTE)
+breaker = CircuitBreaker('openai')